@@ -16,6 +16,8 @@ from PIL import Image, ImageTk
 import os, cv2, ctypes
 import numpy as np
 
+from Ciudadano_lab1_split import splitImage
+
 
 def initWindow() -> None:
   # Creates a window that allows the user to select a file.
@@ -64,9 +66,11 @@ def initWindow() -> None:
       return
     
     image = cv2.imread(filePath)
-    height, width, _ = image.shape
-    image = np.rot90(np.vstack([image[np.mod(np.arange(height), int((height/rows) * 2)) < int(height/rows)], image[np.mod(np.arange(height), int((height/rows) * 2)) >= int(height/rows)]]))
-    image = np.rot90(np.vstack([image[np.mod(np.arange(width), int((width/columns) * 2)) < int(width/columns)], image[np.mod(np.arange(width), int((width/columns) * 2)) >= int(width/columns)]]), k=3)
+    try:
+      image = splitImage(image, rows, columns)
+    except ValueError as error:
+      labelInfo['text'] = str(error)[:40]
+      return
     
     success = cv2.imwrite(os.getcwd() + "/" + "out" + "/" + os.path.basename(filePath), image)
     if success:
@@ -78,7 +82,9 @@ def initWindow() -> None:
     cv2.waitKey()
     cv2.destroyAllWindows()
 
-  ctypes.windll.shcore.SetProcessDpiAwareness(1)
+  # DPI awareness is only available on Windows.
+  if os.name == 'nt':
+    ctypes.windll.shcore.SetProcessDpiAwareness(1)
   window = tk.Tk()
   window.geometry("600x500") 
   window.title("CMSC 174 Lab 1: Image Splitter")
@@ -111,5 +117,6 @@ def initWindow() -> None:
 
   window.mainloop()
 
-os.system('cls')
-initWindow()
\ No newline at end of file
+if __name__ == '__main__':
+  os.system('cls')
+  initWindow()
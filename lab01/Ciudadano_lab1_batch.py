@@ -0,0 +1,119 @@
+'''
+  CMSC 174 Laboratory 1: Image Splitter
+
+  File Name:    Ciudadano_lab1_batch.py
+  Author:       Gio Ciudadano
+  Modified:     18/10/2026 3:40pm
+
+  Description:  This program splits every image in a folder or matching a pattern without opening
+                any windows. Images are decoded and encoded on threads while other images are split.
+'''
+
+import os, sys, cv2, glob, time, queue, argparse, threading, functools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from Ciudadano_lab1_split import splitImage
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')   # Files picked up when a folder is given
+QUEUE_SIZE = 8                                 # Maximum number of decoded or split images waiting in the pipeline
+
+
+def findImages(source : str) -> list:
+  # Returns the sorted paths of the images in a folder, or of the files matching a glob pattern.
+  if os.path.isdir(source):
+    return sorted(os.path.join(source, name) for name in os.listdir(source) if name.lower().endswith(IMAGE_EXTENSIONS))
+  return sorted(glob.glob(source))
+
+def decodeImage(filePath : str) -> tuple:
+  # Reads an image and returns it with the number of seconds it took. Runs on a decoder thread.
+  start = time.perf_counter()
+  image = cv2.imread(filePath)
+  if image is None:
+    raise OSError(f"Could not read image at {filePath}")
+  return image, time.perf_counter() - start
+
+def encodeImage(filePath : str, image) -> float:
+  # Writes an image and returns the number of seconds it took. Runs on an encoder thread.
+  start = time.perf_counter()
+  if not cv2.imwrite(filePath, image):
+    raise OSError(f"Could not write image at {filePath}")
+  return time.perf_counter() - start
+
+def splitImages(filePaths : list, rows : int, columns : int, outputDir : str = 'out', workers : int = os.cpu_count(), queueSize : int = QUEUE_SIZE) -> int:
+  # Splits the given images and writes them to the output folder under the same file names.
+  # Decoding and encoding run on two thread pools, which OpenCV lets run outside of the GIL, while the images are
+  # split on the calling thread. Both queues between the stages are bounded so only a few images are held in memory.
+  # The rows of each image are gathered into one scratch buffer per image shape, reused for every image of that shape.
+  # Prints the decode, split and encode times of each image as it is written, and returns the number of failures.
+  os.makedirs(outputDir, exist_ok=True)
+  decoded = queue.Queue(maxsize=queueSize)
+  encodeSlots = threading.BoundedSemaphore(queueSize)
+  printLock = threading.Lock()
+  results = {'done': 0, 'failed': 0, 'decode': 0.0, 'split': 0.0, 'encode': 0.0}
+  scratches = {}
+
+  def report(filePath : str, decodeTime : float, splitTime : float, future) -> None:
+    # Prints the timings of an image once it has been written, and frees its slot in the encoder queue.
+    encodeSlots.release()
+    with printLock:
+      if future.exception() is not None:
+        results['failed'] += 1
+        print(f"  failed  {filePath}: {future.exception()}", file=sys.stderr)
+        return
+      results['done'] += 1
+      results['decode'] += decodeTime
+      results['split'] += splitTime
+      results['encode'] += future.result()
+      print(f"{decodeTime * 1000:9.1f} {splitTime * 1000:9.1f} {future.result() * 1000:9.1f}  {filePath}")
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=workers) as decoders, ThreadPoolExecutor(max_workers=workers) as encoders:
+    def produce() -> None:
+      # Submits the images to the decoders in order, waiting whenever the queue of decoded images is full.
+      for filePath in filePaths:
+        decoded.put((filePath, decoders.submit(decodeImage, filePath)))
+      decoded.put(None)
+    threading.Thread(target=produce, daemon=True).start()
+
+    print(f"{'decode ms':>9} {'split ms':>9} {'encode ms':>9}  image")
+    while (item := decoded.get()) is not None:
+      filePath, future = item
+      try:
+        image, decodeTime = future.result()
+        splitStart = time.perf_counter()
+        if (image.shape, image.dtype) not in scratches:
+          scratches[(image.shape, image.dtype)] = np.empty_like(image)
+        image = splitImage(image, rows, columns, scratch=scratches[(image.shape, image.dtype)])
+        splitTime = time.perf_counter() - splitStart
+      except (OSError, ValueError) as error:
+        with printLock:
+          results['failed'] += 1
+          print(f"  failed  {filePath}: {error}", file=sys.stderr)
+        continue
+
+      encodeSlots.acquire()
+      outputPath = os.path.join(outputDir, os.path.basename(filePath))
+      encoders.submit(encodeImage, outputPath, image).add_done_callback(functools.partial(report, filePath, decodeTime, splitTime))
+  elapsed = time.perf_counter() - start
+
+  done = results['done']
+  print(f"\n{done} of {len(filePaths)} images split in {elapsed:.2f}s ({done / elapsed if elapsed else 0:.2f} images/s)")
+  if done:
+    print(f"Average per image: decode {results['decode'] / done * 1000:.1f}ms, split {results['split'] / done * 1000:.1f}ms, encode {results['encode'] / done * 1000:.1f}ms")
+  return results['failed']
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Splits every image in a folder or matching a glob pattern without opening a window.")
+  parser.add_argument('source', help="folder of .jpg/.png images, or a glob pattern such as 'photos/*.jpg'")
+  parser.add_argument('rows', type=int)
+  parser.add_argument('columns', type=int)
+  parser.add_argument('--output-dir', default=os.path.join(os.getcwd(), 'out'), help="folder to write the split images to (default: out)")
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of decoder and of encoder threads (default: number of CPUs)")
+  parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE, help=f"maximum number of images waiting between stages (default: {QUEUE_SIZE})")
+  args = parser.parse_args()
+
+  filePaths = findImages(args.source)
+  if not filePaths:
+    sys.exit(f"No images found at {args.source}")
+  sys.exit(1 if splitImages(filePaths, args.rows, args.columns, args.output_dir, args.workers, args.queue_size) else 0)
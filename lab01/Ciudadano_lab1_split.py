@@ -0,0 +1,50 @@
+'''
+  CMSC 174 Laboratory 1: Image Splitter
+
+  File Name:    Ciudadano_lab1_split.py
+  Author:       Gio Ciudadano
+  Modified:     18/10/2026 5:20pm
+
+  Description:  This module splits an image into strips and reassembles every other strip. It has
+                no GUI dependencies, so it can be used on machines without Tk or Pillow.
+'''
+
+import functools
+import numpy as np
+
+SPLIT_CACHE_SIZE = 32   # Number of (height, width, rows, columns) index maps kept in memory
+
+def stripOrder(length : int, parts : int) -> np.ndarray:
+  # Returns the order in which the rows of an image with the given number of rows are taken when it is divided
+  # into strips: every other strip first, then the strips in between.
+  if parts <= 0 or int((length / parts) * 2) == 0:
+    raise ValueError(f"Cannot divide {length} pixels into {parts} strips")
+  strip = int(length / parts)
+  positions = np.mod(np.arange(length), int((length / parts) * 2))
+  return np.concatenate([np.flatnonzero(positions < strip), np.flatnonzero(positions >= strip)])
+
+@functools.lru_cache(maxsize=SPLIT_CACHE_SIZE)
+def splitIndices(height : int, width : int, rows : int, columns : int) -> tuple:
+  # Returns the row and column index maps of the split image, so that the pixel at (y, x) of the split image is
+  # the pixel at (rowIndex[y], columnIndex[x]) of the original image.
+  # The columns are divided in the same way as the rows, but from the right edge of the image, which is the order
+  # in which the original rotate-split-rotate method took them.
+  rowIndex = stripOrder(height, rows)
+  columnIndex = (width - 1 - stripOrder(width, columns))[::-1].copy()
+  rowIndex.flags.writeable = False
+  columnIndex.flags.writeable = False
+  return rowIndex, columnIndex
+
+def splitImage(image : np.ndarray, rows : int, columns : int, out : np.ndarray = None, scratch : np.ndarray = None) -> np.ndarray:
+  # Splits an image into strips horizontally and vertically, and assembles every other strip into the split image.
+  # Only gathers pixels with one np.take per axis, so the input image is not modified and no rotated copies are made.
+  # The rows are gathered into scratch and the columns from scratch into out. Both must have the same dimensions and
+  # type as the image, and are allocated when not given, so passing both splits an image without allocating.
+  # The indices are always in range, so mode='clip' only lets np.take write straight into the given buffers.
+  rowIndex, columnIndex = splitIndices(image.shape[0], image.shape[1], rows, columns)
+  if out is None:
+    out = np.empty_like(image)
+  if scratch is None:
+    scratch = np.empty_like(image)
+  np.take(image, rowIndex, axis=0, out=scratch, mode='clip')
+  return np.take(scratch, columnIndex, axis=1, out=out, mode='clip')
@@ -12,17 +12,171 @@
 '''
 
 import tkinter as tk
-import os, ctypes, json, cv2
+import os, ctypes, json, cv2, functools, hashlib, collections, threading, concurrent.futures, time
 import numpy as np
 from tkinter import filedialog
 from PIL import Image, ImageTk
+from hybrid import Kernel, composite_hybrid, cross_correlation, gaussian_kernel
+from parallel import parallel_correlate
+
+IMAGE_CACHE_SIZE = 4                      # Number of decoded images kept in memory between renders.
+FILTER_CACHE_BUDGET = 256 * 1024 * 1024   # Memory budget in bytes for cached intermediate filter results.
+KERNEL_CACHE_SIZE = 32                    # Number of distinct preset kernels kept between renders.
+RENDER_WORKERS = os.cpu_count()           # Number of background threads used to render filters.
+RENDER_POLL_INTERVAL = 100                # Milliseconds between checks for finished renders.
+CORRELATE_WORKERS = os.cpu_count()        # Number of worker processes a large cross-correlation is split across.
+PARALLEL_MIN_SIZE = 4 * 1024 * 1024       # Smallest image, in pixel values, whose cross-correlation is split across processes.
+
+@functools.lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def decodeImage(filePath : str, modified : float) -> np.array:
+  '''
+    Decodes an image file into a read-only float32 buffer. Results are cached by file path and
+    modification time, so repeated renders of an unchanged file skip decoding entirely.
+
+    Inputs:
+      filePath:   Path to a JPEG or PNG image.
+      modified:   Modification time of the file, used to invalidate the cache when the file changes.
+
+    Output:
+      Returns the decoded image as a float32 array (height x width x 3).
+  '''
+  inputImage = cv2.imread(filePath)
+  if inputImage is None:
+    raise FileNotFoundError(f"Could not read image at {filePath}")
+
+  # The buffer is shared by every stage and every later render, so it must never be modified in place.
+  inputImage = inputImage.astype(np.float32)
+  inputImage.flags.writeable = False
+  return inputImage
+
+def loadImage(image : str | np.ndarray) -> np.array:
+  '''
+    Returns the given image as an array. Paths are decoded through the image cache, while arrays
+    are passed through by reference.
+
+    Inputs:
+      image:  Either a path to an image file or an already-decoded image as a numpy array.
+  '''
+  if isinstance(image, np.ndarray):
+    return image
+  return decodeImage(image, os.path.getmtime(image))
+
+def kernelHash(kernel : Kernel | np.ndarray) -> str:
+  '''
+    Returns a digest of the shape and weights of the given kernel, used to key cached filter results.
+  '''
+  if isinstance(kernel, Kernel):
+    return kernel.digest
+  kernel = np.ascontiguousarray(kernel, dtype=np.float64)
+  return hashlib.sha1(repr(kernel.shape).encode() + kernel.tobytes()).hexdigest()
+
+class FilterCache:
+  '''
+    Least-recently-used cache of intermediate filter results, keyed by the identity of the input image,
+    the hash of the kernel, and the filter stage. The oldest results are evicted once the cached results
+    exceed the memory budget. Cached results are read-only since they are shared between renders.
+  '''
 
-def crossCorrelation(filePath : str, preset : dict, isDisplay : bool) -> np.array:
+  def __init__(self, budget : int = FILTER_CACHE_BUDGET):
+    self.budget = budget
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def fetch(self, stage : str, image : np.ndarray, kernel : np.ndarray, compute) -> np.array:
+    '''
+      Returns the cached result of a filter stage, or computes and caches it on a miss.
+
+      Inputs:
+        stage:    Name of the filter stage.
+        image:    The input image of the stage.
+        kernel:   The kernel applied by the stage.
+        compute:  Called with no arguments to compute the result on a miss.
+    '''
+    # Each entry keeps its input image alive, so the id of a cached image is never reused by another array.
+    # Renders run on several threads, so the bookkeeping is locked. The result itself is computed outside
+    # the lock, and concurrent misses on the same key may compute it twice.
+    key = (stage, id(image), kernelHash(kernel))
+    with self._lock:
+      if key in self._entries:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key][1]
+      self.misses += 1
+
+    output = compute()
+    output.flags.writeable = False
+    with self._lock:
+      if output.nbytes <= self.budget and key not in self._entries:
+        self._entries[key] = (image, output)
+        self.size += output.nbytes
+        while self.size > self.budget:
+          _, (_, evicted) = self._entries.popitem(last=False)
+          self.size -= evicted.nbytes
+    return output
+
+  def clear(self) -> None:
+    with self._lock:
+      self._entries.clear()
+      self.size = 0
+
+  def __str__(self) -> str:
+    return f"Filter cache: {self.hits} hits, {self.misses} misses, {len(self._entries)} results ({self.size / 2**20:.1f} of {self.budget / 2**20:.0f} MB)"
+
+filterCache = FilterCache()
+
+@functools.lru_cache(maxsize=KERNEL_CACHE_SIZE)
+def buildKernel(rows : tuple) -> Kernel:
   '''
-  Computes the cross-correlation of the given filepath with the given kernel.
+    Builds a Kernel from the rows of a preset kernel. Cached so that all stages share one Kernel per distinct kernel.
+  '''
+  return Kernel(rows)
+
+def presetKernel(preset : dict) -> Kernel:
+  '''
+    Returns the kernel of the given preset as a shared Kernel. The preset itself is never modified.
+
+    Raises a KeyError if the preset has no kernel, and a ValueError or TypeError if the kernel is malformed.
+  '''
+  kernel = preset['kernel']
+  if isinstance(kernel, Kernel):
+    return kernel
+  return buildKernel(tuple(map(tuple, np.asarray(kernel).tolist())))
+
+correlatePool = None
+correlatePoolLock = threading.Lock()
+
+def getCorrelatePool() -> concurrent.futures.ProcessPoolExecutor:
+  '''
+    Returns the process pool shared by every large cross-correlation, starting it on first use.
+  '''
+  global correlatePool
+  with correlatePoolLock:
+    if correlatePool is None:
+      correlatePool = concurrent.futures.ProcessPoolExecutor(max_workers=CORRELATE_WORKERS)
+    return correlatePool
+
+def correlateImage(image : str | np.ndarray, kernel : Kernel) -> np.array:
+  '''
+    Cross-correlates the given image with the given kernel, reusing the cached result if the same image
+    was already filtered with the same kernel. Images of at least PARALLEL_MIN_SIZE pixel values are split
+    into row bands across the shared process pool, which gives the same result as a single process.
+  '''
+  inputImage = loadImage(image)
+  if CORRELATE_WORKERS > 1 and inputImage.size >= PARALLEL_MIN_SIZE:
+    compute = lambda: parallel_correlate(inputImage, kernel, CORRELATE_WORKERS, executor=getCorrelatePool())
+  else:
+    compute = lambda: cross_correlation(inputImage, kernel)
+  return filterCache.fetch('cross_correlation', inputImage, kernel, compute)
+
+def crossCorrelation(image : str | np.ndarray, preset : dict, isDisplay : bool) -> np.array:
+  '''
+  Computes the cross-correlation of the given image with the given kernel.
 
   Inputs:
-    filePath:   Either an RGB image (height x width x 3) or a grayscale image
+    image:      A file path, or either an RGB image (height x width x 3) or a grayscale image
                 (height x width) as a numpy array.
     preset:     Contains the kernel responsible for the cross-correlation.
     isDisplay:  Whether to display the output image or not.
@@ -33,37 +187,16 @@ def crossCorrelation(filePath : str, preset : dict, isDisplay : bool) -> np.arra
   '''
     
   try:
-    preset = preset['kernel']
-  except:
+    kernel = presetKernel(preset)
+  except KeyError:
     print("Cross-correlation kernel not found on preset")
     return
-    
-  try:
-    kernelHeight, kernelWidth = np.array(preset).shape
-  except:
+  except (ValueError, TypeError):
     print("Cross-correlation kernel is empty or incorrectly formatted")
     return
     
-  inputImage = cv2.imread(filePath)
-  outputImage = np.empty(inputImage.shape)
-    
-  # Checks if the read image is grayscale or RGB. Initializes the height, width, and depth params of the image.
-  if inputImage.ndim == 3:
-    imageHeight, imageWidth, imageDepth = inputImage.shape
-  else:
-    imageHeight, imageWidth = inputImage.shape
-    imageDepth = 1
-    inputImage = inputImage[:, :, np.newaxis]
-
-  # Places the image to the center of the canvas.
-  canvas = np.zeros((imageHeight+kernelHeight-1, imageWidth+kernelWidth-1, imageDepth), dtype=inputImage.dtype)
-  canvas[(kernelHeight//2):(imageHeight+(kernelHeight//2)), (kernelWidth//2):(imageWidth+(kernelWidth//2))] = inputImage
-    
-  # Samples neighbors according to the kernel and calculates the dot product to form the output image.
-  for x in range(imageWidth):
-    for y in range(imageHeight):
-      sample = np.reshape(canvas[y:y+kernelHeight, x:x+kernelWidth], (kernelHeight * kernelWidth, imageDepth))
-      outputImage[y, x] = np.dot(np.ravel(preset), sample)        
+  # Samples neighbors according to the kernel on a zero-padded canvas. See hybrid.cross_correlation.
+  outputImage = correlateImage(image, kernel)
 
   # Checks if an output screen is to be displayed.
   if (isDisplay):
@@ -71,12 +204,12 @@ def crossCorrelation(filePath : str, preset : dict, isDisplay : bool) -> np.arra
 
   return outputImage
 
-def convolution(filePath : str, preset : dict, isDisplay : bool) -> np.array:
+def convolution(image : str | np.ndarray, preset : dict, isDisplay : bool) -> np.array:
   '''
-    Computes the convolution of the given filepath with the given kernel.
+    Computes the convolution of the given image with the given kernel.
 
     Inputs:
-      filePath:   Either an RGB image (height x width x 3) or a grayscale image
+      image:      A file path, or either an RGB image (height x width x 3) or a grayscale image
                   (height x width) as a numpy array.
       preset:     Contains the kernel responsible for the cross-correlation.
       isDisplay:  Whether to display the output image or not.
@@ -87,22 +220,23 @@ def convolution(filePath : str, preset : dict, isDisplay : bool) -> np.array:
   '''
 
   try:
-    preset['kernel']
-  except:
+    kernel = presetKernel(preset)
+  except KeyError:
     print("Cross-correlation kernel not found on preset")
     return
+  except (ValueError, TypeError):
+    print("Cross-correlation kernel is empty or incorrectly formatted")
+    return
 
   # Simulates convolution by flipping the kernel horizontally and verically.
-  # np.flip(kernel, 1) equivalent to np.fliplr
-  # np.flip(kernel, 0) equivalent to np.flipud
-  preset['kernel'] = np.flip(np.flip(np.array(preset['kernel']), axis=1), axis=0).tolist()
-  output = crossCorrelation(filePath, preset, False)
+  # The flipped kernel is precomputed by Kernel, so the preset is left untouched.
+  output = correlateImage(image, kernel.flipped)
 
   if (isDisplay):
     cv2.imshow('Convolution', output/255)
   return output
 
-def gaussianBlur(sigma, height, width) -> np.array:
+def gaussianBlur(sigma, height, width) -> Kernel:
   '''
   Returns a Gaussian blur kernel of the given dimensions and with the given sigma.
 
@@ -112,32 +246,20 @@ def gaussianBlur(sigma, height, width) -> np.array:
     height: The height of the kernel.
 
     Output:
-      Return a kernel of dimensions width x height such that convolving it
+      Return a Kernel of dimensions height x width such that convolving it
       with an image results in a Gaussian-blurred image.
   '''
-  
-  # Calculates radius
-  kernelX = np.arange(-((width - 1)/2), ((width + 1)/2)) ** 2
-  kernelY = np.arange(-((height - 1)/2), ((height + 1)/2)) ** 2
-
-  # Calculates Gaussian factor equal to exp(-(x^2+y^2)/(2sigma^2))/(2pi*sigma^2)
-  variance = sigma * sigma
-  kernelX = np.exp(- kernelX / (2 * variance))
-  kernelY = np.exp(- kernelY / (2 * variance)) / (2 * variance * np.pi)
-
-  # Computes the outer product of the two vectors and normalizes the kernel for output
-  kernel = np.outer(kernelX, kernelY)
-  sum = np.sum(kernelY) * np.sum(kernelX)
 
-  return kernel / sum
+  # Builds the kernel from the cached normalized 1D Gaussian factors exp(-x^2/(2sigma^2)), so its separable factors are exact.
+  return Kernel.gaussian(sigma, height, width)
 
-def lowPass(filePath : str, preset : dict, isDisplay : bool) -> np.array:
+def lowPass(image : str | np.ndarray, preset : dict, isDisplay : bool) -> np.array:
   '''
-    Computes the low pass of the given filepath with the given sigma. A low pass
+    Computes the low pass of the given image with the given sigma. A low pass
     filter supresses the higher frequency components (finer details) of the image.
 
     Input:
-    filePath:   Either an RGB image (height x width x 3) or a grayscale image
+    image:      A file path, or either an RGB image (height x width x 3) or a grayscale image
                 (height x width) as a numpy array.
     preset:     Contains the blur sigma and size of the Gaussian blur.
     isDisplay:  Whether to display the output image or not.
@@ -158,19 +280,20 @@ def lowPass(filePath : str, preset : dict, isDisplay : bool) -> np.array:
     print("Blur size not found on preset")
     return
   
-  preset['kernel'] = gaussianBlur(preset['blur_sigma'], preset['blur_size'], preset['blur_size'])
-  output = convolution(filePath, preset, False)
+  # Convolves with the shared Gaussian kernel of the preset. A blur size of "auto" sizes the kernel to 3 sigma.
+  kernel = gaussian_kernel(preset['blur_sigma'], preset['blur_size'])
+  output = correlateImage(image, kernel.flipped)
   if (isDisplay):
     cv2.imshow('Low Pass', output/255)
   return output
 
-def highPass(filePath : str, preset : dict, isDisplay : bool) -> np.array:
+def highPass(image : str | np.ndarray, preset : dict, isDisplay : bool) -> np.array:
   '''
-    Computes the high pass of the given filepath with the given sigma. A high pass filter
+    Computes the high pass of the given image with the given sigma. A high pass filter
     suppresses the lower frequency components (coarse details) of the image.
 
     Input:
-    filePath:   Either an RGB image (height x width x 3) or a grayscale image
+    image:      A file path, or either an RGB image (height x width x 3) or a grayscale image
                 (height x width) as a numpy array.
     preset:     Contains the blur sigma and size of the Gaussian blur.
     isDisplay:  Whether to display the output image or not.
@@ -191,21 +314,24 @@ def highPass(filePath : str, preset : dict, isDisplay : bool) -> np.array:
     print("Blur size not found on preset")
     return
 
-  inputImage = cv2.imread(filePath)
-  output = inputImage - lowPass(filePath, preset, False)
+  # Reuses the cached low pass of the same image and Gaussian kernel if available.
+  inputImage = loadImage(image)
+  kernel = gaussian_kernel(preset['blur_sigma'], preset['blur_size'])
+  output = filterCache.fetch('high_pass', inputImage, kernel, lambda: inputImage - lowPass(inputImage, preset, False))
   if (isDisplay):
     cv2.imshow('High Pass', output/255)
   return output
 
-def createHybridImage(filePathL, filePathR, preset):
+def createHybridImage(imageL : str | np.ndarray, imageR : str | np.ndarray, preset : dict, isDisplay : bool = True) -> np.array:
   '''
     Creates a hybrid image based on the specifications of the preset.
 
     Input:
-    filePathL, filePathR:   Either an RGB image (height x width x 3) or a grayscale image
-                            (height x width) as a numpy array.
+    imageL, imageR:         File paths, or either RGB images (height x width x 3) or grayscale
+                            images (height x width) as numpy arrays.
     preset:                 Specifies the blur sigma, blur size, mixin ratio, scale factor,
                             and which image to low/high pass for the hybrid image.
+    isDisplay:              Whether to display the output image or not.
 
     Output:
       Returns an image of the same dimensions as the input image (same width,
@@ -225,18 +351,21 @@ def createHybridImage(filePathL, filePathR, preset):
     print("Missing blur sigma, blur size, high low, mixin ratio, or scale factor parameters in hybrid image")
     return
 
+  # Decodes each image once and passes the buffers through the filter stages.
+  imageL = loadImage(imageL)
+  imageR = loadImage(imageR)
   if (preset['image_a']['high_low']).lower() == 'low':
-    image_a = lowPass(filePathL, preset['image_a'], False) 
-    image_b = highPass(filePathR, preset['image_b'], False)
+    image_a = lowPass(imageL, preset['image_a'], False) 
+    image_b = highPass(imageR, preset['image_b'], False)
   else:
-    image_a = highPass(filePathL, preset['image_a'], False) 
-    image_b = lowPass(filePathR, preset['image_b'], False)
-
-  image_a *= 1 - preset['mixin_ratio']
-  image_b *= preset['mixin_ratio']
+    image_a = highPass(imageL, preset['image_a'], False) 
+    image_b = lowPass(imageR, preset['image_b'], False)
 
-  output = ((image_a + image_b) * preset['scale_factor']).clip(0, 255)
-  cv2.imshow('Hybrid Image', output/255)
+  # Weighs, scales and clips into a single float32 buffer. The filtered images may be shared with the
+  # filter cache, so they are only read.
+  output = composite_hybrid(image_a, image_b, preset['mixin_ratio'], preset['scale_factor'])
+  if (isDisplay):
+    cv2.imshow('Hybrid Image', output/255)
   return output
 
 def uploadImage(widgetImageDisplay : tk.Frame, widgetFileName : tk.Label, target : str) -> None:
@@ -315,13 +444,84 @@ def verifyFilter(*funcs) -> None:
 
   return runFunctions
 
+class RenderQueue:
+  '''
+    Runs filters on a pool of background threads so that the window stays responsive while rendering.
+    Finished renders are picked up on the Tk event loop by polling with after(), since only the main
+    thread may display images and update widgets.
+  '''
+
+  def __init__(self, window : tk.Tk, widgetStatus : tk.Label, workers : int = RENDER_WORKERS):
+    self.window = window
+    self.widgetStatus = widgetStatus
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    self.current = None
+    self.running = []
+    self.polling = False
+
+  def submit(self, title : str, func, *args) -> None:
+    '''
+      Starts rendering a filter in the background and supersedes the previous render. A superseded
+      render is cancelled if it has not started yet; otherwise it finishes on its worker and its
+      result is discarded.
+
+      Parameters:
+        title: Title of the window that displays the output image.
+        func: The filter to run. Must not display the output image itself.
+        args: Arguments passed to the filter.
+    '''
+    if self.current is not None:
+      self.current[1].cancel()
+
+    future = self.executor.submit(func, *args)
+    self.current = (title, future, time.perf_counter())
+    self.running.append(future)
+    if not self.polling:
+      self.polling = True
+      self.window.after(RENDER_POLL_INTERVAL, self.poll)
+
+  def poll(self) -> None:
+    '''
+      Displays the output of the current render once it finishes, and shows its progress otherwise.
+    '''
+    self.running = [future for future in self.running if not future.done()]
+
+    if self.current is not None:
+      title, future, started = self.current
+      elapsed = time.perf_counter() - started
+      if not future.done():
+        superseded = len(self.running) - 1
+        self.widgetStatus['text'] = f"Rendering {title}... {elapsed:.1f}s" + (f" ({superseded} superseded)" if superseded else "")
+      else:
+        self.current = None
+        if future.exception() is not None:
+          self.widgetStatus['text'] = f"{title} failed"
+          print(f"Error: {title} failed: {future.exception()}")
+        elif future.result() is not None:
+          self.widgetStatus['text'] = f"{title} rendered in {elapsed:.2f}s (cache: {filterCache.hits} hits, {filterCache.misses} misses)"
+          cv2.imshow(title, future.result()/255)
+        else:
+          self.widgetStatus['text'] = f"{title} failed"
+
+    if self.current is None and not self.running:
+      self.polling = False
+      return
+    self.window.after(RENDER_POLL_INTERVAL, self.poll)
+
+  def shutdown(self) -> None:
+    self.executor.shutdown(wait=False, cancel_futures=True)
+    if correlatePool is not None:
+      correlatePool.shutdown(wait=False, cancel_futures=True)
+
 
 def initWindow() -> None:
   '''
     Renders the GUI for the laboratory.
   '''
 
-  ctypes.windll.shcore.SetProcessDpiAwareness(1)
+  # DPI awareness is only available on Windows.
+  if os.name == 'nt':
+    ctypes.windll.shcore.SetProcessDpiAwareness(1)
   window = tk.Tk()
   window.geometry("1200x550") 
   window.title("CMSC 174 Lab 2: Image Filters")
@@ -363,19 +563,25 @@ def initWindow() -> None:
   controlsBText.grid(row=5, column=0, pady=(20, 5), sticky='w')
   controlsBAText = tk.Label(master=controls, text='Left Image', fg='gray26', font=('Arial', 7))
   controlsBAText.grid(row=6, column=0, pady=3, sticky='w')
-  crossCorrelationButton = tk.Button(master=controls, text='Cross Correlation...', width=20, font=('Arial', 8), command=verifyFilter(lambda: crossCorrelation(filePathL, presetData['single_image'], True)))
+  renderStatus = tk.Label(master=controls, text='', fg='gray26', font=('Arial', 7))
+  renderStatus.grid(row=13, column=0, padx=5, pady=(10, 2), sticky='w')
+  renderQueue = RenderQueue(window, renderStatus)
+
+  crossCorrelationButton = tk.Button(master=controls, text='Cross Correlation...', width=20, font=('Arial', 8), command=verifyFilter(lambda: renderQueue.submit('Cross Correlation', crossCorrelation, filePathL, presetData['single_image'], False)))
   crossCorrelationButton.grid(row=7, column=0, pady=3)
-  convolutionButton = tk.Button(master=controls, text='Convolution...', width=20, font=('Arial', 8), command=verifyFilter(lambda: convolution(filePathL, presetData['single_image'], True)))
+  convolutionButton = tk.Button(master=controls, text='Convolution...', width=20, font=('Arial', 8), command=verifyFilter(lambda: renderQueue.submit('Convolution', convolution, filePathL, presetData['single_image'], False)))
   convolutionButton.grid(row=8, column=0, pady=3)
-  lowPassButton = tk.Button(master=controls, text='Low Pass...', width=20, font=('Arial', 8), command=verifyFilter(lambda: lowPass(filePathL, presetData['single_image'], True)))
+  lowPassButton = tk.Button(master=controls, text='Low Pass...', width=20, font=('Arial', 8), command=verifyFilter(lambda: renderQueue.submit('Low Pass', lowPass, filePathL, presetData['single_image'], False)))
   lowPassButton.grid(row=9, column=0, pady=3)
-  highPassButton = tk.Button(master=controls, text='High Pass...', width=20, font=('Arial', 8), command=verifyFilter(lambda: highPass(filePathL, presetData['single_image'], True)))
+  highPassButton = tk.Button(master=controls, text='High Pass...', width=20, font=('Arial', 8), command=verifyFilter(lambda: renderQueue.submit('High Pass', highPass, filePathL, presetData['single_image'], False)))
   highPassButton.grid(row=10, column=0, pady=3)
   controlsBAText = tk.Label(master=controls, text='Both Images', fg='gray26', font=('Arial', 7))
   controlsBAText.grid(row=11, column=0, pady=3, sticky='w')
-  hybridImageButton = tk.Button(master=controls, text='Hybrid Image...', width=20, font=('Arial', 8), command=verifyFilter(lambda: createHybridImage(filePathL, filePathR, presetData['hybrid_image'])))
+  hybridImageButton = tk.Button(master=controls, text='Hybrid Image...', width=20, font=('Arial', 8), command=verifyFilter(lambda: renderQueue.submit('Hybrid Image', createHybridImage, filePathL, filePathR, presetData['hybrid_image'], False)))
   hybridImageButton.grid(row=12, column=0, pady=3)
 
   window.mainloop()
+  renderQueue.shutdown()
 
-initWindow()
\ No newline at end of file
+if __name__ == '__main__':
+  initWindow()
\ No newline at end of file
@@ -0,0 +1,145 @@
+import os
+import sys
+import json
+import time
+import argparse
+import cv2
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from hybrid import create_hybrid_image
+
+def load_preset(preset):
+    '''Returns the hybrid image parameters of a preset, given either a path to
+    a preset file like Ciudadano_lab02_preset.json or the preset itself. Both
+    full preset files and bare 'hybrid_image' sections are accepted.'''
+    if isinstance(preset, str):
+        with open(preset) as file:
+            preset = json.load(file)
+    preset = preset.get('hybrid_image', preset)
+
+    for image in ('image_a', 'image_b'):
+        for key in ('blur_sigma', 'blur_size', 'high_low'):
+            if key not in preset.get(image, {}):
+                raise ValueError(f"Preset is missing {image}.{key}")
+    for key in ('mixin_ratio', 'scale_factor'):
+        if key not in preset:
+            raise ValueError(f"Preset is missing {key}")
+    return preset
+
+def load_manifest(path, output_dir):
+    '''Reads a JSON manifest of hybrid image jobs. The manifest is a list of
+    objects with 'left', 'right' and 'preset' entries and an optional
+    'output' entry, e.g.
+
+        [{"left": "a.jpg", "right": "b.jpg", "preset": "preset.json"}]
+
+    Relative paths are resolved against the directory of the manifest, and
+    each preset file is read only once. Jobs without an output are written to
+    <left>_<right>_hybrid_<job number>.png in the output directory, and two
+    jobs may not write to the same file.
+
+    Output:
+        Return a list of jobs with absolute paths and loaded presets.
+    '''
+    with open(path) as file:
+        entries = json.load(file)
+    base = os.path.dirname(os.path.abspath(path))
+
+    presets = {}
+    jobs = []
+    outputs = {}
+    for number, entry in enumerate(entries, 1):
+        left = os.path.join(base, entry['left'])
+        right = os.path.join(base, entry['right'])
+        preset = entry['preset']
+        if isinstance(preset, str):
+            preset = os.path.join(base, preset)
+            if preset not in presets:
+                presets[preset] = load_preset(preset)
+            preset = presets[preset]
+        else:
+            preset = load_preset(preset)
+
+        output = entry.get('output')
+        if output is None:
+            name = f"{os.path.splitext(os.path.basename(left))[0]}_" \
+                f"{os.path.splitext(os.path.basename(right))[0]}_hybrid_{number}.png"
+            output = os.path.join(output_dir, name)
+        else:
+            output = os.path.join(base, output)
+
+        key = os.path.normcase(os.path.abspath(output))
+        if key in outputs:
+            raise ValueError(f"Jobs {outputs[key]} and {number} both write to {output}")
+        outputs[key] = number
+        jobs.append({'left': left, 'right': right, 'preset': preset,
+            'output': output})
+    return jobs
+
+def run_job(job):
+    '''Creates and writes the hybrid image of a single job. Runs in a worker
+    process.
+
+    Output:
+        Return the number of seconds the job took.
+    '''
+    start = time.perf_counter()
+    img1 = cv2.imread(job['left'])
+    img2 = cv2.imread(job['right'])
+    if img1 is None or img2 is None:
+        raise FileNotFoundError(
+            f"Could not read image at {job['left'] if img1 is None else job['right']}")
+    if img1.shape != img2.shape:
+        raise ValueError(f"Images have different dimensions {img1.shape} and {img2.shape}")
+
+    preset = job['preset']
+    a, b = preset['image_a'], preset['image_b']
+    hybrid_img = create_hybrid_image(img1, img2,
+        a['blur_sigma'], a['blur_size'], a['high_low'],
+        b['blur_sigma'], b['blur_size'], b['high_low'],
+        preset['mixin_ratio'], preset['scale_factor'])
+
+    os.makedirs(os.path.dirname(os.path.abspath(job['output'])), exist_ok=True)
+    if not cv2.imwrite(job['output'], hybrid_img):
+        raise OSError(f"Could not write image at {job['output']}")
+    return time.perf_counter() - start
+
+def run_batch(jobs, workers=None):
+    '''Runs the given jobs on a process pool, printing the time of each job as
+    it finishes and the total throughput at the end.
+
+    Output:
+        Return the number of failed jobs.
+    '''
+    failures = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                seconds = future.result()
+                print(f"{seconds:8.2f}s  {job['output']}")
+            except Exception as error:
+                failures += 1
+                print(f"  failed  {job['left']} + {job['right']}: {error}",
+                    file=sys.stderr)
+    elapsed = time.perf_counter() - start
+
+    done = len(jobs) - failures
+    print(f"\n{done} of {len(jobs)} hybrid images in {elapsed:.2f}s "
+        f"({done / elapsed if elapsed else 0:.2f} images/s)")
+    return failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Creates hybrid images for every (left, right, preset) job in a manifest without a display.")
+    parser.add_argument('manifest', help="JSON list of {left, right, preset[, output]} jobs")
+    parser.add_argument('--output-dir', default='out',
+        help="directory for jobs without an explicit output (default: out)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+        help="number of worker processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    jobs = load_manifest(args.manifest, args.output_dir)
+    sys.exit(1 if run_batch(jobs, args.workers) else 0)
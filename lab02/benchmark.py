@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import cv2
+import numpy as np
+
+from hybrid import (convolution, create_hybrid_image, cross_correlation,
+    high_pass, low_pass)
+
+LAB_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Synthetic image sizes as (width, height), from VGA up to 24 MP.
+IMAGE_SIZES = {
+    'vga': (640, 480),
+    'hd': (1280, 720),
+    'fhd': (1920, 1080),
+    '12mp': (4000, 3000),
+    '24mp': (6000, 4000),
+}
+
+# Kernel sizes of the presets: the 3x3 sharpen kernel and the 12 and 20 px
+# Gaussian blurs, with the sigmas used for them in Ciudadano_lab02_preset.json.
+KERNEL_SIGMAS = {3: 1, 12: 5, 20: 20}
+
+STAGES = ('cross_correlation', 'convolution', 'low_pass', 'high_pass', 'hybrid')
+
+# A run is a regression when it is slower or uses more memory than the
+# baseline by more than these fractions.
+TIME_TOLERANCE = 0.25
+MEMORY_TOLERANCE = 0.10
+
+def load_images(name, channels):
+    '''Returns the (left, right) uint8 image pair of the given size name, or
+    the bundled Ciudadano_lab02_left/right.jpg pair for 'bundled'.'''
+    if name == 'bundled':
+        images = [cv2.imread(os.path.join(LAB_DIR, f'Ciudadano_lab02_{side}.jpg'))
+            for side in ('left', 'right')]
+        if channels == 1:
+            images = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) for image in images]
+        return images
+
+    width, height = IMAGE_SIZES[name]
+    shape = (height, width) if channels == 1 else (height, width, channels)
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 256, shape, dtype=np.uint8) for _ in range(2)]
+
+def stage_function(stage, left, right, size):
+    '''Returns a function that runs the given stage once on the given images
+    with a kernel of the given size.'''
+    sigma = KERNEL_SIGMAS.get(size, size / 4)
+    image = left.astype(np.float32)
+    if size == 3:
+        kernel = np.array([[0, -1, 0], [-1, 5, -1], [0, -1, 0]], dtype=np.float32)
+    else:
+        kernel = np.random.default_rng(size).random((size, size), dtype=np.float32)
+
+    if stage == 'cross_correlation':
+        return lambda: cross_correlation(image, kernel)
+    if stage == 'convolution':
+        return lambda: convolution(image, kernel)
+    if stage == 'low_pass':
+        return lambda: low_pass(image, sigma, size)
+    if stage == 'high_pass':
+        return lambda: high_pass(image, sigma, size)
+    return lambda: create_hybrid_image(left, right, sigma, size, 'low', sigma,
+        size, 'high', 0.5, 2)
+
+def measure(func, repeats):
+    '''Returns the best wall time of the given number of runs, and the peak
+    memory allocated during one more run traced with tracemalloc.'''
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak
+
+def run_benchmarks(images, channels, kernels, stages, repeats):
+    '''Runs every combination of the given stages, image sizes, channel
+    counts and kernel sizes, printing each result as it finishes.
+
+    Output:
+        Return a list of results with the wall time, pixels per second and
+        peak memory of each combination.
+    '''
+    results = []
+    for name in images:
+        for channel_count in channels:
+            left, right = load_images(name, channel_count)
+            pixels = left.shape[0] * left.shape[1]
+            for size in kernels:
+                for stage in stages:
+                    seconds, peak = measure(stage_function(stage, left, right, size), repeats)
+                    result = {'stage': stage, 'image': name,
+                        'width': left.shape[1], 'height': left.shape[0],
+                        'channels': channel_count, 'kernel': size,
+                        'seconds': seconds, 'pixels_per_second': pixels / seconds,
+                        'peak_bytes': peak}
+                    results.append(result)
+                    print(f"{stage:<18} {name:>8} x{channel_count} k{size:<3} "
+                        f"{seconds:9.3f}s {pixels / seconds / 1e6:9.2f} MP/s "
+                        f"{peak / 2**20:9.1f} MB", flush=True)
+    return results
+
+def result_key(result):
+    return (result['stage'], result['image'], result['channels'], result['kernel'])
+
+def compare(results, baseline, time_tolerance=TIME_TOLERANCE,
+        memory_tolerance=MEMORY_TOLERANCE):
+    '''Compares results against baseline results of the same combinations.
+
+    Output:
+        Return a list of messages describing each regression.
+    '''
+    previous = {result_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        label = "{} {} x{} k{}".format(*result_key(result))
+        if result['seconds'] > old['seconds'] * (1 + time_tolerance):
+            regressions.append(f"{label}: {result['seconds']:.3f}s, "
+                f"baseline {old['seconds']:.3f}s "
+                f"(+{result['seconds'] / old['seconds'] - 1:.0%})")
+        if result['peak_bytes'] > old['peak_bytes'] * (1 + memory_tolerance):
+            regressions.append(f"{label}: {result['peak_bytes'] / 2**20:.1f} MB, "
+                f"baseline {old['peak_bytes'] / 2**20:.1f} MB "
+                f"(+{result['peak_bytes'] / old['peak_bytes'] - 1:.0%})")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the lab02 filter stages and checks for regressions against a baseline.")
+    parser.add_argument('--images', nargs='+', default=['bundled', *IMAGE_SIZES],
+        choices=['bundled', *IMAGE_SIZES])
+    parser.add_argument('--channels', nargs='+', type=int, default=[1, 3])
+    parser.add_argument('--kernels', nargs='+', type=int, default=list(KERNEL_SIGMAS))
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default='benchmark_results.json',
+        help="JSON file to write the results to")
+    parser.add_argument('--baseline', help="JSON results file to compare against")
+    parser.add_argument('--save-baseline', action='store_true',
+        help="write the results to the baseline file instead of comparing")
+    parser.add_argument('--time-tolerance', type=float, default=TIME_TOLERANCE)
+    parser.add_argument('--memory-tolerance', type=float, default=MEMORY_TOLERANCE)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.images, args.channels, args.kernels,
+        args.stages, args.repeats)
+    report = {
+        'environment': {'python': platform.python_version(),
+            'numpy': np.__version__, 'opencv': cv2.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Baseline written to {args.baseline}")
+    elif args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.time_tolerance,
+            args.memory_tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} REGRESSIONS against {args.baseline}:",
+                file=sys.stderr)
+            for regression in regressions:
+                print(f"  {regression}", file=sys.stderr)
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
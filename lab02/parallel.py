@@ -0,0 +1,158 @@
+import os
+import sys
+import time
+import argparse
+import cv2
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from hybrid import Kernel, choose_method, correlate, gaussian_blur, separable_factors
+
+# Number of row bands per worker process. More bands than workers balances
+# the load at the cost of some repeated halo rows.
+BANDS_PER_WORKER = 2
+
+def _correlate_band(input_name, input_dtype, output_name, output_dtype, shape,
+        kernel, method, start, stop):
+    '''Cross-correlates rows start to stop of the image in the shared input
+    block and writes them to the same rows of the shared output block. Runs
+    in a worker process.'''
+    input_memory = shared_memory.SharedMemory(name=input_name)
+    output_memory = shared_memory.SharedMemory(name=output_name)
+    try:
+        img = np.ndarray(shape, dtype=input_dtype, buffer=input_memory.buf)
+        output = np.ndarray(shape, dtype=output_dtype, buffer=output_memory.buf)
+
+        # The band is read with a halo of kernel rows above and below it, so
+        # only the rows past the image border fall back to zero padding.
+        kernel_height = kernel.shape[0]
+        first = max(start - kernel_height // 2, 0)
+        last = min(stop + kernel_height - 1 - kernel_height // 2, shape[0])
+        band = correlate(img[first:last], kernel, method)
+        output[start:stop] = band[start - first:stop - first]
+
+        # The views must be released before the blocks can be closed.
+        del img, output
+    finally:
+        input_memory.close()
+        output_memory.close()
+
+def parallel_correlate(img, kernel, workers=None, method='auto', executor=None):
+    '''Compute the cross correlation of the given image with the given kernel
+    on several processes. The image is split into row bands that overlap by
+    the kernel radius, and the bands are stitched back into an output equal
+    to correlate(img, kernel). The image and the output are exchanged
+    through shared memory rather than pickled.
+
+    Inputs:
+        img:      Either an RGB image (height x width x 3) or a grayscale image
+                  (height x width) as a numpy array.
+        kernel:   A 2D numpy array (m x n) or a Kernel.
+        workers:  Number of worker processes. Defaults to the number of CPUs;
+                  1 runs in the calling process.
+        method:   As in hybrid.correlate. 'auto' is resolved once for the
+                  whole image so that every band uses the same algorithm,
+                  which makes the direct and separable results identical to
+                  the single-process ones (FFT matches up to rounding).
+        executor: An optional ProcessPoolExecutor to reuse across calls.
+
+    Output:
+        Return an image of the same dimensions as the input image (same width,
+        height and the number of color channels)
+    '''
+    if not isinstance(kernel, Kernel):
+        kernel = np.asarray(kernel)
+        if kernel.ndim != 2 or kernel.size == 0:
+            raise ValueError("Kernel must be a non-empty 2D array")
+    if method == 'auto':
+        if isinstance(kernel, Kernel):
+            factors = kernel.factors
+        else:
+            factors = separable_factors(kernel)
+        method = choose_method(img.shape, kernel, factors)
+
+    workers = workers or os.cpu_count()
+    if workers == 1 and executor is None:
+        return correlate(img, kernel, method)
+
+    dtype = np.result_type(img.dtype, np.asarray(kernel).dtype, np.float32)
+    height = img.shape[0]
+    bands = min(workers * BANDS_PER_WORKER, height)
+    bounds = np.linspace(0, height, bands + 1).astype(int)
+
+    input_memory = shared_memory.SharedMemory(create=True, size=max(img.nbytes, 1))
+    output_memory = shared_memory.SharedMemory(create=True,
+        size=max(img.size * dtype.itemsize, 1))
+    try:
+        shared_input = np.ndarray(img.shape, dtype=img.dtype, buffer=input_memory.buf)
+        shared_input[...] = img
+        del shared_input
+
+        pool = executor or ProcessPoolExecutor(max_workers=workers)
+        try:
+            futures = [pool.submit(_correlate_band, input_memory.name,
+                img.dtype.str, output_memory.name, dtype.str, img.shape, kernel,
+                method, start, stop)
+                for start, stop in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                future.result()
+        finally:
+            if executor is None:
+                pool.shutdown()
+
+        return np.ndarray(img.shape, dtype=dtype, buffer=output_memory.buf).copy()
+    finally:
+        input_memory.close()
+        input_memory.unlink()
+        output_memory.close()
+        output_memory.unlink()
+
+def benchmark_scaling(img, kernel, max_workers=None, method='auto', repeats=3):
+    '''Prints the throughput of parallel_correlate for 1 up to max_workers
+    processes, taking the best of the given number of repeats for each.'''
+    max_workers = max_workers or os.cpu_count()
+    reference = correlate(img, kernel, method)
+    baseline = None
+
+    print(f"Image {img.shape}, kernel {kernel.shape}, method {method}")
+    for workers in range(1, max_workers + 1):
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            executor = pool if workers > 1 else None
+            # The first call starts the worker processes and is not timed.
+            output = parallel_correlate(img, kernel, workers, method, executor)
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                parallel_correlate(img, kernel, workers, method, executor)
+                timings.append(time.perf_counter() - start)
+
+        best = min(timings)
+        baseline = baseline or best
+        identical = np.array_equal(output, reference)
+        print(f"{workers:>3} workers  {best:8.3f}s  "
+            f"{img.shape[0] * img.shape[1] / best / 1e6:8.2f} MP/s  "
+            f"{baseline / best:5.2f}x  {'identical' if identical else 'differs'}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Measures how tile-parallel cross-correlation scales with the number of processes.")
+    parser.add_argument('image', nargs='?', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'Ciudadano_lab02_left.jpg'))
+    parser.add_argument('--size', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'),
+        help="resize the image before filtering")
+    parser.add_argument('--blur-size', type=int, default=20)
+    parser.add_argument('--blur-sigma', type=float, default=20)
+    parser.add_argument('--method', default='auto',
+        choices=['auto', 'direct', 'separable', 'fft'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    image = cv2.imread(args.image)
+    if image is None:
+        sys.exit(f"Could not read image at {args.image}")
+    if args.size:
+        image = cv2.resize(image, tuple(args.size))
+    benchmark_scaling(image, gaussian_blur(args.blur_sigma, args.blur_size,
+        args.blur_size), args.workers, args.method, args.repeats)
@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+from hybrid import create_hybrid_image, gaussian_kernel, high_pass, low_pass
+
+# Height and width of the tiles read from the source images. Peak memory is
+# proportional to the tile area plus the halo, not to the image size.
+DEFAULT_TILE_SIZE = 1024
+
+def open_image(path, shape=None, dtype=np.uint8):
+    '''Memory-maps an image stored as a .npy file or as raw pixels, without
+    reading it into memory.
+
+    Inputs:
+        path:  Path to a .npy file, or to a raw file of row-major pixels.
+        shape: The (height, width) or (height, width, channels) of a raw file.
+        dtype: The pixel type of a raw file.
+    '''
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    if shape is None:
+        raise ValueError(f"Raw image {path} needs an explicit shape")
+    return np.memmap(path, dtype=dtype, mode='r', shape=tuple(shape))
+
+def create_image(path, shape, dtype=np.float32):
+    '''Creates a memory-mapped .npy or raw image file of the given shape and
+    type for the output tiles to be written into.'''
+    if path.endswith('.npy'):
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+            shape=tuple(shape))
+    return np.memmap(path, dtype=dtype, mode='w+', shape=tuple(shape))
+
+def kernel_halo(kernel):
+    '''Returns the number of (top, bottom, left, right) neighbor pixels the
+    given kernel reads around each output pixel.'''
+    height, width = kernel.shape
+    return (height // 2, height - 1 - height // 2,
+        width // 2, width - 1 - width // 2)
+
+def stream_filter(sources, destination, func, halo, tile_size=DEFAULT_TILE_SIZE):
+    '''Applies a filter tile by tile. Each tile is read from the sources
+    together with a halo of neighbor pixels, filtered, cropped back to the
+    tile and written to the destination. Since the halo covers the kernel,
+    the output equals filtering the whole image at once (up to rounding),
+    including the zero boundary at the image borders. The destination is
+    flushed after every row of tiles.
+
+    Inputs:
+        sources:     The input images, e.g. memory-mapped with open_image.
+                     They must share their height and width.
+        destination: The output image, e.g. memory-mapped with create_image.
+        func:        Called with one tile per source; returns the filtered
+                     tile with the same height and width.
+        halo:        The (top, bottom, left, right) halo, see kernel_halo.
+        tile_size:   The height and width of the tiles.
+
+    Output:
+        Return the destination.
+    '''
+    height, width = destination.shape[:2]
+    for source in sources:
+        if source.shape[:2] != (height, width):
+            raise ValueError(f"Image dimensions {source.shape[:2]} do not match {(height, width)}")
+
+    top, bottom, left, right = halo
+    for y in range(0, height, tile_size):
+        tile_height = min(tile_size, height - y)
+        first_row = max(y - top, 0)
+        last_row = min(y + tile_height + bottom, height)
+        for x in range(0, width, tile_size):
+            tile_width = min(tile_size, width - x)
+            first_column = max(x - left, 0)
+            last_column = min(x + tile_width + right, width)
+
+            tiles = [np.array(source[first_row:last_row, first_column:last_column])
+                for source in sources]
+            output = func(*tiles)
+            destination[y:y + tile_height, x:x + tile_width] = output[
+                y - first_row:y - first_row + tile_height,
+                x - first_column:x - first_column + tile_width]
+
+        if hasattr(destination, 'flush'):
+            destination.flush()
+    return destination
+
+def stream_low_pass(source, destination, sigma, size, tile_size=DEFAULT_TILE_SIZE):
+    '''Tiled version of hybrid.low_pass, reading from source and writing to
+    destination (preferably float32). See stream_filter.'''
+    return stream_filter([source], destination,
+        lambda tile: low_pass(tile, sigma, size),
+        kernel_halo(gaussian_kernel(sigma, size)), tile_size)
+
+def stream_high_pass(source, destination, sigma, size, tile_size=DEFAULT_TILE_SIZE):
+    '''Tiled version of hybrid.high_pass, reading from source and writing to
+    destination (preferably float32, since the high pass is signed). See
+    stream_filter.'''
+    return stream_filter([source], destination,
+        lambda tile: high_pass(tile, sigma, size),
+        kernel_halo(gaussian_kernel(sigma, size)), tile_size)
+
+def stream_hybrid_image(source1, source2, destination, sigma1, size1, high_low1,
+        sigma2, size2, high_low2, mixin_ratio, scale_factor,
+        tile_size=DEFAULT_TILE_SIZE):
+    '''Tiled version of hybrid.create_hybrid_image, reading from the two
+    sources and writing uint8 pixels to destination. The halo is the larger
+    of the halos of the two Gaussian kernels. See stream_filter.'''
+    halo = np.maximum(kernel_halo(gaussian_kernel(sigma1, size1)),
+        kernel_halo(gaussian_kernel(sigma2, size2)))
+    return stream_filter([source1, source2], destination,
+        lambda tile1, tile2: create_hybrid_image(tile1, tile2, sigma1, size1,
+            high_low1, sigma2, size2, high_low2, mixin_ratio, scale_factor),
+        tuple(halo), tile_size)
+
+if __name__ == '__main__':
+    from batch import load_preset
+
+    parser = argparse.ArgumentParser(
+        description="Creates a hybrid image from two .npy or raw images that do not fit in memory.")
+    parser.add_argument('left')
+    parser.add_argument('right')
+    parser.add_argument('output', help=".npy or raw output file (uint8)")
+    parser.add_argument('--preset', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'Ciudadano_lab02_preset.json'))
+    parser.add_argument('--shape', type=int, nargs='+', metavar='N',
+        help="height, width and optionally channels of raw inputs")
+    parser.add_argument('--dtype', default='uint8', help="pixel type of raw inputs")
+    parser.add_argument('--tile-size', type=int, default=DEFAULT_TILE_SIZE)
+    args = parser.parse_args()
+
+    left = open_image(args.left, args.shape, args.dtype)
+    right = open_image(args.right, args.shape, args.dtype)
+    if left.shape != right.shape:
+        sys.exit(f"Images have different dimensions {left.shape} and {right.shape}")
+    output = create_image(args.output, left.shape, np.uint8)
+
+    preset = load_preset(args.preset)
+    a, b = preset['image_a'], preset['image_b']
+    start = time.perf_counter()
+    stream_hybrid_image(left, right, output,
+        a['blur_sigma'], a['blur_size'], a['high_low'],
+        b['blur_sigma'], b['blur_size'], b['high_low'],
+        preset['mixin_ratio'], preset['scale_factor'], args.tile_size)
+    elapsed = time.perf_counter() - start
+    print(f"{left.shape[0] * left.shape[1] / 1e6:.1f} MP in {elapsed:.2f}s "
+        f"({left.shape[0] * left.shape[1] / elapsed / 1e6:.2f} MP/s)")
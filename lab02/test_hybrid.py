@@ -0,0 +1,28 @@
+import pickle
+
+import numpy as np
+
+from hybrid import Kernel, correlate, gaussian_kernel
+from parallel import parallel_correlate
+
+def test_pickled_kernel_keeps_factors():
+    '''A pickled kernel must come back with the same weights and factors, so
+    that worker processes correlate exactly like the parent.'''
+    kernels = [Kernel.gaussian(3, 7, 9), gaussian_kernel(5, 15),
+        Kernel.from_factors([1, 2, 1], [1, 0, -1]), Kernel([[1, 2], [3, 1]])]
+    for kernel in kernels:
+        restored = pickle.loads(pickle.dumps(kernel))
+        assert restored == kernel
+        assert np.array_equal(restored.weights, kernel.weights)
+        if kernel.factors is None:
+            assert restored.factors is None
+        else:
+            for factor, restored_factor in zip(kernel.factors, restored.factors):
+                assert np.array_equal(factor, restored_factor)
+        assert np.array_equal(restored.flipped.weights, kernel.flipped.weights)
+
+def test_parallel_separable_matches_correlate():
+    img = np.random.default_rng(0).random((64, 48, 3), dtype=np.float32)
+    for kernel in (Kernel.gaussian(3, 7, 9), gaussian_kernel(5, 15)):
+        expected = correlate(img, kernel, 'separable')
+        assert np.array_equal(parallel_correlate(img, kernel, 2, 'separable'), expected)
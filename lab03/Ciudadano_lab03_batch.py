@@ -0,0 +1,112 @@
+'''
+  CMSC 174 Laboratory 3: Image Blending
+
+  File Name:    Ciudadano_lab03_batch.py
+  Author:       Gio Ciudadano
+  Modified:     18/10/2026 3:12pm
+
+  Description:  This program blends a list of image pairs without prompting the user or opening
+                any windows, running the blends on several processes.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import cv2
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from Ciudadano_lab03_blending import BLEND_MODE, BLUR_MODE, STACK_SIZE, create_blended_image
+
+def load_jobs(path: str) -> list:
+  '''
+    Reads a JSON list of blending jobs, each with an "image_a", "image_b", "mask" and "output" path, e.g.
+      [{"image_a": "left.png", "image_b": "right.png", "mask": "verticalmask.png", "output": "out/blend.png"}]
+    Relative paths are resolved against the folder of the job list.
+
+    Parameters:
+      path - The path to the JSON job list.
+  '''
+  with open(path) as file:
+    entries = json.load(file)
+  base = os.path.dirname(os.path.abspath(path))
+
+  jobs = []
+  for entry in entries:
+    for key in ("image_a", "image_b", "mask", "output"):
+      if key not in entry:
+        raise Exception(f"Job {len(jobs)+1} in {path} is missing {key}")
+    jobs.append({key: os.path.join(base, entry[key]) for key in ("image_a", "image_b", "mask", "output")})
+  return jobs
+
+def run_job(job: dict, mode: str = BLEND_MODE, levels: int = STACK_SIZE, blur: str = BLUR_MODE, channel_workers: int = 1) -> float:
+  '''
+    Blends and writes the images of a single job, and returns the number of seconds it took. Runs in a worker process.
+    The Gaussian stack of the mask is cached in the worker, so jobs sharing a mask only filter it once per worker.
+
+    Parameters:
+      job - The image_a, image_b, mask and output paths of the job.
+      mode, levels, blur - See blend_images.
+      channel_workers - The number of threads to filter the color channels of a stack on.
+  '''
+  start = time.perf_counter()
+  image_a = cv2.imread(job["image_a"])
+  image_b = cv2.imread(job["image_b"])
+  mask = cv2.imread(job["mask"], cv2.IMREAD_GRAYSCALE)
+  for image, key in ((image_a, "image_a"), (image_b, "image_b"), (mask, "mask")):
+    if image is None:
+      raise Exception(f"Could not find image at {job[key]}")
+  if image_a.shape != image_b.shape or image_a.shape[:2] != mask.shape:
+    raise Exception(f"Images and mask have different dimensions {image_a.shape}, {image_b.shape} and {mask.shape}")
+
+  os.makedirs(os.path.dirname(job["output"]), exist_ok=True)
+  if channel_workers > 1:
+    with ThreadPoolExecutor(max_workers=channel_workers) as executor:
+      create_blended_image(image_a, image_b, mask, mode, levels, blur, job["output"], False, executor)
+  else:
+    create_blended_image(image_a, image_b, mask, mode, levels, blur, job["output"], False)
+  return time.perf_counter() - start
+
+def run_batch(jobs: list, workers: int = None, mode: str = BLEND_MODE, levels: int = STACK_SIZE, blur: str = BLUR_MODE, channel_workers: int = 1) -> int:
+  '''
+    Runs the given jobs on a process pool, printing the latency of each job as it finishes and the total throughput
+    at the end. Returns the number of failed jobs.
+
+    Parameters:
+      jobs - The jobs to run, see load_jobs.
+      workers - The number of worker processes.
+      mode, levels, blur, channel_workers - See run_job.
+  '''
+  failures = 0
+  latencies = []
+  start = time.perf_counter()
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    futures = {pool.submit(run_job, job, mode, levels, blur, channel_workers): job for job in jobs}
+    for future in as_completed(futures):
+      job = futures[future]
+      try:
+        latencies.append(future.result())
+        print(f"{latencies[-1]:8.3f}s  {job['output']}")
+      except Exception as error:
+        failures += 1
+        print(f"  failed  {job['image_a']} + {job['image_b']}: {error}", file=sys.stderr)
+  elapsed = time.perf_counter() - start
+
+  if latencies:
+    print(f"\nLatency: mean {sum(latencies) / len(latencies):.3f}s, min {min(latencies):.3f}s, max {max(latencies):.3f}s")
+  print(f"{len(latencies)} of {len(jobs)} blended images in {elapsed:.2f}s ({len(latencies) / elapsed if elapsed else 0:.2f} images/s)")
+  return failures
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Blends every (image_a, image_b, mask, output) job in a JSON list without a display.")
+  parser.add_argument('jobs', help="JSON list of {image_a, image_b, mask, output} jobs")
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of worker processes (default: number of CPUs)")
+  parser.add_argument('--channel-workers', type=int, default=1, help="number of threads per job to filter the color channels on (default: 1)")
+  parser.add_argument('--mode', default=BLEND_MODE, choices=["stack", "pyramid"])
+  parser.add_argument('--levels', type=int, default=STACK_SIZE)
+  parser.add_argument('--blur', default=BLUR_MODE, choices=["exact", "box"])
+  args = parser.parse_args()
+
+  jobs = load_jobs(args.jobs)
+  sys.exit(1 if run_batch(jobs, args.workers, args.mode, args.levels, args.blur, args.channel_workers) else 0)
@@ -10,12 +10,22 @@
 '''
 
 import os
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt
 import scipy
 
 STACK_SIZE = 5
+BLEND_MODE = "stack"    # Either "stack" for full-resolution Gaussian/Laplacian stacks or "pyramid" for downsampled pyramids.
+STACK_SIGMA = 16        # Sigma of the Gaussian filter applied between two levels of a stack.
+BLUR_MODE = "exact"     # Either "exact" for a true Gaussian filter or "box" for iterated box filters with a cost independent of sigma.
+BOX_PASSES = 3          # Number of box filters used to approximate each Gaussian filter in "box" mode.
+MASK_CACHE_SIZE = 4     # Number of mask Gaussian stacks kept in memory, keyed by the content of the mask.
+
+mask_stack_cache = OrderedDict()
 
 def display_laboratory_details() -> str:
   '''
@@ -30,63 +40,322 @@ def display_laboratory_details() -> str:
   print("2. Show Creatively-Blended Image")
   return input("\n\x1b[38;5;228mPlease select an option:\x1b[37m ")
 
-def create_gaussian_laplacian_stack(image: np.array):
+def box_filter_sizes(sigma: float, passes: int = BOX_PASSES) -> list:
+  '''
+    Returns the widths of the box filters whose repeated application has the same variance as a Gaussian filter.
+    The widths are odd and differ by at most 2 so that the filters stay centered.
+
+    Parameters:
+      sigma - The sigma of the Gaussian filter to approximate.
+      passes - The number of box filters.
+  '''
+  lower = int(np.sqrt(12 * sigma**2 / passes + 1))
+  if lower % 2 == 0:
+    lower -= 1
+  upper = lower + 2
+  lower_passes = round((12 * sigma**2 - passes * lower**2 - 4 * passes * lower - 3 * passes) / (-4 * lower - 4))
+  return [lower] * lower_passes + [upper] * (passes - lower_passes)
+
+def spatial_gaussian_filter(image: np.array, sigma: float, output: np.array, scratch: np.array, blur: str = BLUR_MODE):
+  '''
+    Filters the rows and columns of an image with either the same truncated Gaussian kernel as scipy ("exact") or
+    with iterated box filters ("box"), whose cost per pixel does not depend on sigma. The color channels, if any,
+    are filtered independently.
+
+    Parameters:
+      image - The float32 image to filter. It may be the same buffer as scratch.
+      sigma - The sigma of the Gaussian filter.
+      output - The float32 buffer to write the filtered image to.
+      scratch - A float32 buffer of the same dimensions used between the passes.
+      blur - Either "exact" or "box".
+  '''
+  if blur == "exact":
+    radius = int(4.0 * sigma + 0.5)
+    kernel = np.exp(-0.5 * (np.arange(-radius, radius+1) / sigma)**2)
+    kernel /= kernel.sum()
+    return cv2.sepFilter2D(image, -1, kernel, kernel, dst=output, borderType=cv2.BORDER_REFLECT)
+
+  sizes = box_filter_sizes(sigma)
+  source = image
+  for i, size in enumerate(sizes):
+    destination = output if (len(sizes) - 1 - i) % 2 == 0 else scratch
+    cv2.blur(source, (size, size), dst=destination, borderType=cv2.BORDER_REFLECT)
+    source = destination
+  return output
+
+def stack_gaussian_filter(image: np.array, sigma: float, output: np.array, scratch: np.array, blur: str = BLUR_MODE, executor: ThreadPoolExecutor = None):
+  '''
+    Computes scipy.ndimage.gaussian_filter with the same sigma on every axis, including the color channels.
+    The color channels are filtered first by mixing them with a small matrix, since the Gaussian filter of a
+    color axis with only a few channels reduces to one. The rows and columns are then filtered with the
+    spatial_gaussian_filter, one color channel per thread of the executor if one is given. OpenCV releases the
+    GIL while filtering, so the channels are filtered in parallel.
+
+    Parameters:
+      image - The float32 image to filter.
+      sigma - The sigma of the Gaussian filter.
+      output - The float32 buffer to write the filtered image to.
+      scratch - A float32 buffer of the same dimensions used between the passes.
+      blur - Either "exact" or "box".
+      executor - An optional thread pool to filter the color channels on.
+  '''
+  if image.ndim == 2:
+    return spatial_gaussian_filter(image, sigma, output, scratch, blur)
+
+  channel_matrix = scipy.ndimage.gaussian_filter1d(np.eye(image.shape[2]), sigma, axis=1).T
+  cv2.transform(image, channel_matrix, dst=scratch)
+  if executor is None:
+    return spatial_gaussian_filter(scratch, sigma, output, scratch, blur)
+
+  channels = executor.map(lambda channel: spatial_gaussian_filter(channel, sigma, np.empty_like(channel), channel, blur), cv2.split(scratch))
+  return cv2.merge(list(channels), dst=output)
+
+def create_gaussian_stack(image: np.array, levels: int = STACK_SIZE, blur: str = BLUR_MODE, executor: ThreadPoolExecutor = None):
+  '''
+    Creates and returns the gaussian stack of a given image, by applying a Gaussian filter to the current image and
+    pushing it to the stack. The image is converted to float32 once, and every level is written into a preallocated
+    float32 buffer.
+
+    Parameters:
+      image - The current image to create a stack with. Requires np.array type.
+      levels - The number of filtered levels in the stack.
+      blur - Either "exact" for a true Gaussian filter or "box" for iterated box filters, see stack_gaussian_filter.
+      executor - An optional thread pool to filter the color channels on.
+  '''
+  if blur not in ("exact", "box"):
+    raise Exception(f"Unknown blur mode {blur}. Please use exact or box.")
+  gaussian_stack = np.empty((levels+1, *image.shape), dtype=np.float32)
+  gaussian_stack[0] = image
+  scratch = np.empty(image.shape, dtype=np.float32)
+  for i in range(0, levels):
+    stack_gaussian_filter(gaussian_stack[i], STACK_SIGMA, gaussian_stack[i+1], scratch, blur, executor)
+  return gaussian_stack
+
+def create_gaussian_laplacian_stack(image: np.array, levels: int = STACK_SIZE, blur: str = BLUR_MODE, executor: ThreadPoolExecutor = None):
   '''
     Creates and returns a gaussian and laplacian stack of a given image.
       Gaussian stack: Applies a Gaussian filter to the current image and pushes it to the stack.
       Laplacian stack: Calculates the difference between the current image and the last image in the stack.
-    
+
     Parameters:
       image - The current image to create a stack with. Requires np.array type.
+      levels - The number of levels in the Laplacian stack.
+      blur - Either "exact" for a true Gaussian filter or "box" for iterated box filters, see stack_gaussian_filter.
+      executor - An optional thread pool to filter the color channels on.
   '''
-  gaussian_stack = [image]
-  laplacian_stack = []
-  for i in range(0, STACK_SIZE):
-    gaussian_stack.append(scipy.ndimage.gaussian_filter(gaussian_stack[i].astype(np.float32), sigma=16))
-    laplacian_stack.append(gaussian_stack[i]-gaussian_stack[i+1])
+  gaussian_stack = create_gaussian_stack(image, levels, blur, executor)
+  laplacian_stack = np.empty((levels, *image.shape), dtype=np.float32)
+  for i in range(0, levels):
+    np.subtract(gaussian_stack[i], gaussian_stack[i+1], out=laplacian_stack[i])
   return gaussian_stack, laplacian_stack
 
-def create_blended_image(image_a : np.array, image_b : np.array, mask: np.array):
+def create_gaussian_pyramid(image: np.array, levels: int = STACK_SIZE):
+  '''
+    Creates and returns the gaussian pyramid of a given image, by blurring and halving the current image and pushing
+    it to the pyramid. Each level has a quarter of the pixels of the level before it, so the whole pyramid costs
+    about 4/3 of a single full-resolution level instead of one full-resolution blur per level.
+
+    Parameters:
+      image - The current image to create a pyramid with. Requires np.array type.
+      levels - The number of downsampled levels in the pyramid.
+  '''
+  gaussian_pyramid = [image.astype(np.float32)]
+  for i in range(0, levels):
+    gaussian_pyramid.append(cv2.pyrDown(gaussian_pyramid[i]))
+  return gaussian_pyramid
+
+def create_gaussian_laplacian_pyramid(image: np.array, levels: int = STACK_SIZE):
+  '''
+    Creates and returns a gaussian and laplacian pyramid of a given image.
+      Gaussian pyramid: Blurs and halves the current image and pushes it to the pyramid.
+      Laplacian pyramid: Calculates the difference between the current image and the upsampled next image in the pyramid.
+
+    Parameters:
+      image - The current image to create a pyramid with. Requires np.array type.
+      levels - The number of levels in the Laplacian pyramid.
+  '''
+  gaussian_pyramid = create_gaussian_pyramid(image, levels)
+  laplacian_pyramid = []
+  for i in range(0, levels):
+    height, width = gaussian_pyramid[i].shape[:2]
+    laplacian_pyramid.append(gaussian_pyramid[i]-cv2.pyrUp(gaussian_pyramid[i+1], dstsize=(width, height)))
+  return gaussian_pyramid, laplacian_pyramid
+
+def create_mask_stack(mask: np.array, mode: str = BLEND_MODE, levels: int = STACK_SIZE, blur: str = BLUR_MODE):
+  '''
+    Creates and returns the Gaussian stack or pyramid of a blending mask, without the unused Laplacian levels.
+    A color mask whose channels are all equal is reduced to a single channel first, which gives the same levels
+    for a third of the work. The result is cached by the content of the mask, so blending many image pairs with
+    the same mask only filters it once. The cached levels are read-only.
+
+    Parameters:
+      mask - The blending mask, from 0 to 255, with either one channel or color channels.
+      mode - Either "stack" or "pyramid".
+      levels - The number of filtered levels.
+      blur - Either "exact" or "box", the Gaussian filter used in stack mode.
+  '''
+  if mask.ndim == 3 and all(np.array_equal(mask[..., 0], mask[..., i]) for i in range(1, mask.shape[2])):
+    mask = mask[..., 0]
+  mask = np.ascontiguousarray(mask)
+  key = (hashlib.sha1(mask.data).hexdigest(), mask.shape, mask.dtype.str, mode, levels, blur)
+  if key in mask_stack_cache:
+    mask_stack_cache.move_to_end(key)
+    return mask_stack_cache[key]
+
+  gaussian_mask = create_gaussian_stack(mask, levels, blur) if mode == "stack" else create_gaussian_pyramid(mask, levels)
+  # The stack is a single array, whose levels are views that are read-only once the array is. The pyramid is a list of levels.
+  if mode == "stack":
+    gaussian_mask.flags.writeable = False
+  else:
+    for level in gaussian_mask:
+      level.flags.writeable = False
+  mask_stack_cache[key] = gaussian_mask
+  if len(mask_stack_cache) > MASK_CACHE_SIZE:
+    mask_stack_cache.popitem(last=False)
+  return gaussian_mask
+
+def add_blended_level(accumulator: np.array, level_a: np.array, level_b: np.array, mask_level: np.array, weight: np.array, difference: np.array):
+  '''
+    Adds one level of the blend of two images to the accumulator. The mask level is normalized into a weight once,
+    and the blend level_a * weight + level_b * (1-weight) is computed as level_b + weight * (level_a - level_b),
+    which needs one multiplication instead of two and no temporary arrays. A single-channel mask level is broadcast
+    across the color channels of the images.
+
+    Parameters:
+      accumulator - The float32 buffer to add the blended level to.
+      level_a, level_b - The levels of the images to blend.
+      mask_level - The level of the mask, from 0 to 255.
+      weight - A float32 buffer of the dimensions of the mask level used as scratch space.
+      difference - A float32 buffer of the dimensions of the image levels used as scratch space.
+  '''
+  np.multiply(mask_level, 1/255, out=weight)
+  np.subtract(level_a, level_b, out=difference)
+  difference *= weight if weight.ndim == difference.ndim else weight[..., np.newaxis]
+  accumulator += level_b
+  accumulator += difference
+  return accumulator
+
+def collapse_blended_stack(image_a: np.array, image_b: np.array, gaussian_mask: np.array, levels: int = STACK_SIZE, blur: str = BLUR_MODE,
+    executor: ThreadPoolExecutor = None):
+  '''
+    Blends the Laplacian stacks of two images level by level using the Gaussian stack of the mask, one level deeper than the
+    Laplacian level, and collapses the result into a single float32 accumulator. The stacks of the images are never stored:
+    each Laplacian level L_i = G_i - G_{i+1} is computed and blended as soon as the next Gaussian level is filtered, so only
+    two Gaussian levels per image are kept at a time. Including the accumulator and scratch space, the blend needs seven
+    image buffers whatever the number of levels.
+
+    Parameters:
+      image_a, image_b - The images to blend.
+      gaussian_mask - The Gaussian stack of the mask, see create_mask_stack.
+      levels - The number of levels in the Laplacian stacks.
+      blur - Either "exact" or "box", see stack_gaussian_filter.
+      executor - An optional thread pool to filter the color channels on.
+  '''
+  if blur not in ("exact", "box"):
+    raise Exception(f"Unknown blur mode {blur}. Please use exact or box.")
+  current_a, current_b = image_a.astype(np.float32), image_b.astype(np.float32)
+  next_a, next_b = np.empty_like(current_a), np.empty_like(current_b)
+  scratch = np.empty_like(current_a)
+  accumulator = np.zeros(current_a.shape, dtype=np.float32)
+  weight = np.empty(gaussian_mask[0].shape, dtype=np.float32)
+  difference = np.empty_like(current_a)
+  for i in range(0, levels):
+    stack_gaussian_filter(current_a, STACK_SIGMA, next_a, scratch, blur, executor)
+    stack_gaussian_filter(current_b, STACK_SIGMA, next_b, scratch, blur, executor)
+
+    # The Gaussian level i is only needed for the Laplacian level i, so the Laplacian level is written over it.
+    np.subtract(current_a, next_a, out=current_a)
+    np.subtract(current_b, next_b, out=current_b)
+    add_blended_level(accumulator, current_a, current_b, gaussian_mask[i+1], weight, difference)
+    current_a, next_a = next_a, current_a
+    current_b, next_b = next_b, current_b
+  return accumulator
+
+def collapse_blended_pyramid(laplacian_a : list, laplacian_b : list, gaussian_a : list, gaussian_b : list, gaussian_mask : list):
+  '''
+    Blends two Laplacian pyramids level by level using the Gaussian pyramid of the mask, and collapses the result by
+    repeatedly upsampling it and adding the next finer blended level. The coarsest level of the two Gaussian pyramids
+    is blended the same way and used as the base of the collapse.
+
+    Parameters:
+      laplacian_a, laplacian_b - The Laplacian pyramids of the images to blend.
+      gaussian_a, gaussian_b - The Gaussian pyramids of the images to blend.
+      gaussian_mask - The Gaussian pyramid of the mask.
+  '''
+  levels = len(laplacian_a)
+  blended = np.zeros(gaussian_a[levels].shape, dtype=np.float32)
+  add_blended_level(blended, gaussian_a[levels], gaussian_b[levels], gaussian_mask[levels], np.empty(gaussian_mask[levels].shape, dtype=np.float32), np.empty_like(blended))
+  for i in reversed(range(levels)):
+    height, width = laplacian_a[i].shape[:2]
+    blended = cv2.pyrUp(blended, dstsize=(width, height))
+    add_blended_level(blended, laplacian_a[i], laplacian_b[i], gaussian_mask[i], np.empty(gaussian_mask[i].shape, dtype=np.float32), np.empty_like(blended))
+  return blended
+
+def blend_images(image_a : np.array, image_b : np.array, mask: np.array, mode : str = BLEND_MODE, levels : int = STACK_SIZE, blur : str = BLUR_MODE, executor : ThreadPoolExecutor = None) -> np.array:
   '''
-    Seamlessly creates a blended image by combining the Laplacian stacks of the given images for each layer.
+    Seamlessly blends two images by combining the Laplacian stacks of the given images for each layer.
     Weights and filters the given images using a Gaussian stack of the given image mask.
+    Returns the blended image as float32, normalized from 0 to 1.
 
     Parameters:
       image_a, image_b - The images to seamlessly blend.
-      mask - Defines the weights to blend the image.
+      mask - Defines the weights to blend the image. Either a single-channel mask, which is used for every color
+             channel, or a mask with the same channels as the images.
+      mode - Either "stack" for full-resolution stacks or "pyramid" for downsampled pyramids.
+      levels - The number of levels in the stacks or pyramids.
+      blur - Either "exact" or "box", the Gaussian filter used in stack mode.
+      executor - An optional thread pool to filter the color channels on in stack mode.
   '''
-  _, laplacian_a = create_gaussian_laplacian_stack(image_a)
-  _, laplacian_b = create_gaussian_laplacian_stack(image_b)
-  gaussian_mask, _ = create_gaussian_laplacian_stack(mask)
-  
-  blend = []
-  for i in range(STACK_SIZE):
-    blend.append((laplacian_a[i] * (gaussian_mask[i+1]/255)) + (laplacian_b[i] * (1-(gaussian_mask[i+1]/255))))
-  blended_image = cv2.normalize(sum(blend), None, 0, 1.0, cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-  cv2.imwrite('Ciudadano_lab03_blendvert.png', blended_image*255)
-  cv2.imshow('Blended Image', blended_image)
-  cv2.waitKey(0)
+  if mode == "stack":
+    gaussian_mask = create_mask_stack(mask, mode, levels, blur)
+    blended_sum = collapse_blended_stack(image_a, image_b, gaussian_mask, levels, blur, executor)
+  elif mode == "pyramid":
+    gaussian_a, laplacian_a = create_gaussian_laplacian_pyramid(image_a, levels)
+    gaussian_b, laplacian_b = create_gaussian_laplacian_pyramid(image_b, levels)
+    gaussian_mask = create_mask_stack(mask, mode, levels)
+    blended_sum = collapse_blended_pyramid(laplacian_a, laplacian_b, gaussian_a, gaussian_b, gaussian_mask)
+  else:
+    raise Exception(f"Unknown blend mode {mode}. Please use stack or pyramid.")
+  return cv2.normalize(blended_sum, None, 0, 1.0, cv2.NORM_MINMAX, dtype=cv2.CV_32F)
+
+def create_blended_image(image_a : np.array, image_b : np.array, mask: np.array, mode : str = BLEND_MODE, levels : int = STACK_SIZE, blur : str = BLUR_MODE, output : str = 'Ciudadano_lab03_blendvert.png', display : bool = True, executor : ThreadPoolExecutor = None):
+  '''
+    Seamlessly creates a blended image with blend_images, writes it to the output file and displays it.
+
+    Parameters:
+      image_a, image_b, mask, mode, levels, blur, executor - See blend_images.
+      output - The file to write the blended image to.
+      display - Whether to show the blended image in a window and wait for a key press.
+  '''
+  blended_image = blend_images(image_a, image_b, mask, mode, levels, blur, executor)
+  if not cv2.imwrite(output, np.rint(blended_image*255).astype(np.uint8)):
+    raise Exception(f"Could not write blended image to {output}")
+  if display:
+    cv2.imshow('Blended Image', blended_image)
+    cv2.waitKey(0)
+  return blended_image
   
 '''
   Prompts the user to select an image display option.
 '''
-selectedOption : str = display_laboratory_details()
-match selectedOption:
-  case "1":
-    try:
-      image_a = cv2.imread("Ciudadano_lab03_left.png")
-      image_b = cv2.imread("Ciudadano_lab03_right.png")
-      mask = cv2.imread("Ciudadano_lab03_verticalmask.png")
-    except:
-      raise Exception("Could not find images or image mask")
-    create_blended_image(image_a, image_b, mask)
-  case "2":
-    try:
-      image_a = cv2.imread("Ciudadano_lab03_crazyone.png")
-      image_b = cv2.imread("Ciudadano_lab03_crazytwo.png")
-      mask = cv2.imread("Ciudadano_lab03_crazymask.png")
-    except:
-      raise Exception("Could not find images or image mask")
-    create_blended_image(image_a, image_b, mask)
-  case _:
-    raise Exception("No option selected. Please run the program again.")
\ No newline at end of file
+if __name__ == '__main__':
+  selectedOption : str = display_laboratory_details()
+  match selectedOption:
+    case "1":
+      try:
+        image_a = cv2.imread("Ciudadano_lab03_left.png")
+        image_b = cv2.imread("Ciudadano_lab03_right.png")
+        mask = cv2.imread("Ciudadano_lab03_verticalmask.png", cv2.IMREAD_GRAYSCALE)
+      except:
+        raise Exception("Could not find images or image mask")
+      create_blended_image(image_a, image_b, mask)
+    case "2":
+      try:
+        image_a = cv2.imread("Ciudadano_lab03_crazyone.png")
+        image_b = cv2.imread("Ciudadano_lab03_crazytwo.png")
+        mask = cv2.imread("Ciudadano_lab03_crazymask.png", cv2.IMREAD_GRAYSCALE)
+      except:
+        raise Exception("Could not find images or image mask")
+      create_blended_image(image_a, image_b, mask)
+    case _:
+      raise Exception("No option selected. Please run the program again.")
\ No newline at end of file
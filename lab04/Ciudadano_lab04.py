@@ -10,6 +10,8 @@
 '''
 
 import os
+import json
+import threading
 import numpy as np
 import cv2
 
@@ -21,6 +23,51 @@ CALIBRATION_PIXEL_VALUE = 850             # Defines the value of a pixel in the
 CALIBRATION_MINIMUM_AREA_SIZE = 1000      # Defines the minimum and maximum sizes for contour rejection when finding the container with the fluid.
 CALIBRATION_MAXIMUM_AREA_SIZE = 400000
 
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')  # Files measured in a directory of images. Other files, such as the ROI file, are skipped.
+
+# Images can be decoded straight to grayscale at 1/2, 1/4 or 1/8 of their size. The calibration constants above are for full-size images
+# and are scaled to the decoded size. A scale of 1 decodes the full-size color image.
+DECODE_SCALE = 1
+DECODE_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+# Calibration fitted by Ciudadano_lab04_calibration.py. When the file exists, it replaces the threshold, dilate/erode iterations, pixel value
+# and decode scale above.
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Ciudadano_lab04_calibration.json")
+
+def load_calibration(path : str = CALIBRATION_FILE) -> bool:
+  '''
+    Replaces the calibration constants with the ones saved in a calibration file, if it exists.
+
+    Parameters:
+      Path - Path of the calibration file.
+
+    Returns:
+      Loaded - Whether the calibration file was found and loaded.
+  '''
+  global CALIBRATION_MINIMUM_THRESHOLD, CALIBRATION_DILATE_ERODE_ITERS, CALIBRATION_PIXEL_VALUE, DECODE_SCALE
+  if not os.path.exists(path):
+    return False
+  with open(path) as file:
+    calibration = json.load(file)
+  CALIBRATION_MINIMUM_THRESHOLD = calibration["minimum_threshold"]
+  CALIBRATION_DILATE_ERODE_ITERS = calibration["dilate_erode_iters"]
+  CALIBRATION_PIXEL_VALUE = calibration["pixel_value"]
+  DECODE_SCALE = calibration.get("decode_scale", DECODE_SCALE)
+  return True
+
+load_calibration()
+
+# Region of interest. When enabled, the bounding box of the fluid contour is detected once per directory, or read from the ROI file in the
+# directory, and only that crop of the following images is thresholded and contoured. A box read from a ROI file is [x, y, width, height] in
+# full-size pixels.
+ROI_MARGIN = 0.25                         # Margin added on each side of the detected fluid contour, as a fraction of its width and height.
+ROI_FILE_NAME = "roi.json"
+roi_boxes = {}                            # Box of each directory in full-size pixels, or None if the fluid could not be found to detect it.
+roi_lock = threading.Lock()
+
+# On-disk cache of the accepted contour areas of each image, so unchanged images are not decoded and contoured again.
+AREA_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Ciudadano_lab04_cache.json")
+
 def display_laboratory_details() -> str:
   '''
     Displays information about the current laboratory and prompts the user to select an option.
@@ -36,71 +83,358 @@ def display_laboratory_details() -> str:
   print("4. 350mL")
   return input("\n\x1b[38;5;228mPlease select an option:\x1b[37m ")
 
-def get_volume(image : np.array):
+def find_contours(image_gray : np.array, scale : int = 1, threshold : int = None, iterations : int = None) -> list:
   '''
-    Uses thresholding to isolate possible fluids and construct a set of contours. Selects a contour containing the fluid based on criteria.
-    Measures the area of the selected contour and calculates the volume using a pre-defined calibration constant.
+    Uses thresholding to isolate possible fluids and construct a set of contours, and returns the contours that could contain the fluid.
 
     Parameters:
-      Image - The image for which a container contains an unspecified volume of a fluid.
+      Image_gray, Scale, Threshold, Iterations - See get_contour_areas().
 
     Returns:
-      Volume - The volume of a fluid in a container from the given image.
-
+      Contours - (area, contour) pairs of the accepted contours, with the areas in full-size pixels.
   '''
-  
-  # Converts the image to grayscale and uses thresholding to find edges, then dilates and erodes multiple times to further isolate the edges.
-  image_gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-  _, edges = cv2.threshold(image_gray, CALIBRATION_MINIMUM_THRESHOLD,255,cv2.THRESH_BINARY)
-  edges = cv2.dilate(edges, None, iterations=CALIBRATION_DILATE_ERODE_ITERS)
-  edges = cv2.erode(edges, None, iterations=CALIBRATION_DILATE_ERODE_ITERS)
+  threshold = CALIBRATION_MINIMUM_THRESHOLD if threshold is None else threshold
+  iterations = CALIBRATION_DILATE_ERODE_ITERS if iterations is None else iterations
+
+  # Uses thresholding to find edges, then dilates and erodes multiple times to further isolate the edges.
+  iterations = max(1, round(iterations / scale))
+  _, edges = cv2.threshold(image_gray, threshold,255,cv2.THRESH_BINARY)
+  edges = cv2.dilate(edges, None, iterations=iterations)
+  edges = cv2.erode(edges, None, iterations=iterations)
   
   # From the given edges, constructs a list of contours. Checks the area of each contour and rejects contours that are too small or too large based
   # on pre-defined calibration constants.
   contours, _ = cv2.findContours(edges, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
   contours_filtered = []
-  contours_filtered_area = []
   for contour in contours:
-    contour_area = cv2.contourArea(contour)
+    contour_area = cv2.contourArea(contour) * scale**2
     if (contour_area > CALIBRATION_MINIMUM_AREA_SIZE and contour_area < CALIBRATION_MAXIMUM_AREA_SIZE):
-      contours_filtered.append(contour)
-      contours_filtered_area.append(contour_area)
+      contours_filtered.append((contour_area, contour))
+  return contours_filtered
+
+def get_contour_areas(image_gray : np.array, scale : int = 1, threshold : int = None, iterations : int = None) -> list:
+  '''
+    Uses thresholding to isolate possible fluids and construct a set of contours, and returns the areas of the contours that could contain the fluid.
+
+    Parameters:
+      Image_gray - The grayscale image for which a container contains an unspecified volume of a fluid.
+      Scale - How many times smaller the image is than the full-size images the calibration constants are for. Areas are
+              scaled by the square of the scale, and the dilate/erode iterations by the scale.
+      Threshold, Iterations - The threshold cutoff and dilate/erode iterations for full-size images. Defaults to the calibration constants.
+
+    Returns:
+      Areas - The areas of the accepted contours, in full-size pixels.
+  '''
+  return [contour_area for contour_area, _ in find_contours(image_gray, scale, threshold, iterations)]
+
+def detect_roi(contours : list, image_shape : tuple, scale : int = 1) -> tuple:
+  '''
+    Finds the bounding box of the largest of the accepted contours, which contains the fluid, and widens it by ROI_MARGIN on each side.
+
+    Parameters:
+      Contours - The accepted contours of the whole image, see find_contours().
+      Image_shape - The shape of the image the contours were found in.
+      Scale - How many times smaller the image is than the full-size images.
+
+    Returns:
+      Box - The (x, y, width, height) box in full-size pixels, or None if there are no accepted contours.
+  '''
+  if not contours:
+    return None
+  x, y, width, height = cv2.boundingRect(max(contours, key=lambda contour: contour[0])[1])
+  margin_x, margin_y = round(width * ROI_MARGIN), round(height * ROI_MARGIN)
+  left, top = max(0, x - margin_x), max(0, y - margin_y)
+  right, bottom = min(image_shape[1], x + width + margin_x), min(image_shape[0], y + height + margin_y)
+  return (left * scale, top * scale, (right - left) * scale, (bottom - top) * scale)
+
+def get_roi_contour_areas(image_gray : np.array, box : tuple, scale : int = 1) -> list:
+  '''
+    Finds the contours that could contain the fluid in a box of the image only, so that thresholding, dilating, eroding and contouring cost
+    shrinks with the area of the box. Contours reaching an edge of the box, unless that edge is also an edge of the image, are rejected
+    since the crop cuts them. The box is only valid if the largest remaining contour covers the center of the box, as the fluid does when
+    the box was detected from it.
+
+    Parameters:
+      Image_gray - The grayscale image.
+      Box - The (x, y, width, height) box in full-size pixels, see detect_roi().
+      Scale - How many times smaller the image is than the full-size images.
+
+    Returns:
+      Areas - The areas of the accepted contours in the box in full-size pixels, or None if the box is not valid for this image.
+  '''
+  image_height, image_width = image_gray.shape[:2]
+  left, top = min(box[0] // scale, image_width), min(box[1] // scale, image_height)
+  right, bottom = min(-(-(box[0] + box[2]) // scale), image_width), min(-(-(box[1] + box[3]) // scale), image_height)
+
+  # Dilating and eroding can change the contours up to twice the number of iterations away from a cut edge, so those are rejected too.
+  # A box outside the image, or too small to hold anything past that band, is not valid.
+  band = 2 * max(1, round(CALIBRATION_DILATE_ERODE_ITERS / scale))
+  if right - left <= 2 * band or bottom - top <= 2 * band:
+    return None
+  contours_inside = []
+  for contour_area, contour in find_contours(image_gray[top:bottom, left:right], scale):
+    x, y, width, height = cv2.boundingRect(contour)
+    if (x < band and left > 0) or (y < band and top > 0) or (x + width > right - left - band and right < image_width) or \
+        (y + height > bottom - top - band and bottom < image_height):
+      continue
+    contours_inside.append((contour_area, contour))
+  if not contours_inside:
+    return None
+
+  x, y, width, height = cv2.boundingRect(max(contours_inside, key=lambda contour: contour[0])[1])
+  if not (x <= (right - left) / 2 <= x + width and y <= (bottom - top) / 2 <= y + height):
+    return None
+  return [contour_area for contour_area, _ in contours_inside]
 
-  # Selects the largest of the accepted contours as the contour containing the fluid inside a container and divides it with a pre-defined calibration
-  # constant to get the total volume of the fluid. 
+def get_roi(directory : str) -> tuple:
+  '''
+    Returns the box of a directory, reading it from the ROI file in the directory the first time if there is one. The ROI file must hold
+    four integers, [x, y, width, height], with x and y at least 0 and a positive width and height. A box that does not fit the images,
+    such as one past their edges, is replaced by a detected one, see measure_areas().
+
+    Parameters:
+      Directory - The directory of the images.
+
+    Returns:
+      Box - The (x, y, width, height) box in full-size pixels, or None if it is not known yet.
+  '''
+  with roi_lock:
+    if directory not in roi_boxes:
+      path = os.path.join(directory, ROI_FILE_NAME)
+      if os.path.exists(path):
+        with open(path) as file:
+          box = json.load(file)
+        if not (isinstance(box, list) and len(box) == 4 and all(isinstance(value, int) and not isinstance(value, bool) for value in box)
+            and box[0] >= 0 and box[1] >= 0 and box[2] > 0 and box[3] > 0):
+          raise Exception(f"The ROI file {path} must hold [x, y, width, height] in pixels, not {box}")
+        roi_boxes[directory] = tuple(box)
+    return roi_boxes.get(directory)
+
+def get_volume(image : np.array, scale : int = 1):
+  '''
+    Uses thresholding to isolate possible fluids and construct a set of contours. Selects a contour containing the fluid based on criteria.
+    Measures the area of the selected contour and calculates the volume using a pre-defined calibration constant.
+
+    Parameters:
+      Image - The image for which a container contains an unspecified volume of a fluid. Either a color or a grayscale image.
+      Scale - How many times smaller the image is than the full-size images the calibration constants are for, see get_contour_areas().
+
+    Returns:
+      Volume - The volume of a fluid in a container from the given image.
+
+  '''
+  
+  # Converts the image to grayscale and finds the areas of the contours that could contain the fluid.
+  image_gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+  return get_volume_from_areas(get_contour_areas(image_gray, scale))
+
+def get_volume_from_areas(contours_filtered_area : list) -> float:
+  '''
+    Selects the largest of the accepted contours as the contour containing the fluid inside a container and divides it with a pre-defined calibration
+    constant to get the total volume of the fluid.
+
+    Parameters:
+      Contours_filtered_area - The areas of the accepted contours, see get_contour_areas().
+  '''
+  if not contours_filtered_area:
+    raise Exception("Could not find a contour containing the fluid")
   return max(contours_filtered_area)/CALIBRATION_PIXEL_VALUE
 
-def get_average_volume(dir):
+def read_grayscale(file_path : str, scale : int = None) -> np.array:
+  '''
+    Reads an image as grayscale.
+
+    Parameters:
+      File_path - Path of the image.
+      Scale - Either 1 to decode the full-size color image and convert it, or 2, 4 or 8 to decode a grayscale image that many times smaller.
+              Defaults to DECODE_SCALE.
+  '''
+  scale = DECODE_SCALE if scale is None else scale
+  if scale not in DECODE_FLAGS:
+    raise Exception(f"Unsupported decode scale {scale}. Please use 1, 2, 4 or 8.")
+  image = cv2.imread(file_path, DECODE_FLAGS[scale])
+  if image is None:
+    raise Exception(f"Could not read image at {file_path}")
+  return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+def measure_areas(file_path : str, scale : int = None, roi : bool = False) -> list:
+  '''
+    Reads an image and returns the areas of the contours that could contain the fluid, see get_contour_areas().
+    In ROI mode, only the box of the directory of the image is contoured. The whole image is contoured instead when the box is not known
+    yet or is not valid for the image, and the box of the directory is then detected again from it.
+
+    Parameters:
+      File_path - Path of the image.
+      Scale - The decode scale, see read_grayscale(). Defaults to DECODE_SCALE.
+      Roi - Whether to use ROI mode.
+  '''
+  scale = DECODE_SCALE if scale is None else scale
+  image_gray = read_grayscale(file_path, scale)
+  if not roi:
+    return get_contour_areas(image_gray, scale)
+
+  directory = os.path.dirname(os.path.abspath(file_path))
+  box = get_roi(directory)
+  if box is not None:
+    areas = get_roi_contour_areas(image_gray, box, scale)
+    if areas is not None:
+      return areas
+
+  contours = find_contours(image_gray, scale)
+  with roi_lock:
+    roi_boxes[directory] = detect_roi(contours, image_gray.shape, scale)
+  return [contour_area for contour_area, _ in contours]
+
+def measure_image(file_path : str, scale : int = None, cache = None, roi : bool = False) -> float:
+  '''
+    Reads an image and returns the volume of the fluid in it with get_volume().
+
+    Parameters:
+      File_path - Path of the image.
+      Scale - The decode scale, see read_grayscale(). Defaults to DECODE_SCALE.
+      Cache - An optional AreaCache to look the contour areas up in, and to store them in when they are measured.
+      Roi - Whether to use ROI mode, see measure_areas().
+  '''
+  if cache is None:
+    return get_volume_from_areas(measure_areas(file_path, scale, roi))
+  if scale is not None and scale != cache.parameters["decode_scale"]:
+    raise Exception(f"The area cache is for decode scale {cache.parameters['decode_scale']}, not {scale}")
+  if roi != ("roi_margin" in cache.parameters):
+    raise Exception(f"The area cache is for {'' if roi else 'no '}ROI mode")
+  scale = cache.parameters["decode_scale"]
+  areas = cache.get(file_path)
+  if areas is None:
+    areas = measure_areas(file_path, scale, roi)
+    cache.put(file_path, areas)
+  return get_volume_from_areas(areas)
+
+class AreaCache:
+  '''
+    On-disk cache of the accepted contour areas of each image, keyed by the path, size and modification time of the image file.
+    All areas in a cache file are measured with the same threshold, dilate/erode iterations, decode scale and area limits. When any
+    of these change, or when the ROI mode or margin changes, the whole cache is invalidated. In ROI mode, each image is also keyed by
+    the modification time of the ROI file of its directory, so editing, adding or removing the ROI file invalidates its images.
+    The pixel value is not one of the parameters, so volumes can be recomputed with a new pixel value from the cache alone. The cache
+    can be used from several threads.
+
+    Parameters:
+      Path - Path of the cache file.
+      Scale - The decode scale the areas are measured at. Defaults to DECODE_SCALE.
+      Roi - Whether the areas are measured in ROI mode, see measure_areas().
+  '''
+
+  def __init__(self, path : str = AREA_CACHE_FILE, scale : int = None, roi : bool = False):
+    self.path = path
+    self.parameters = {"minimum_threshold": CALIBRATION_MINIMUM_THRESHOLD, "dilate_erode_iters": CALIBRATION_DILATE_ERODE_ITERS,
+      "decode_scale": DECODE_SCALE if scale is None else scale,
+      "minimum_area_size": CALIBRATION_MINIMUM_AREA_SIZE, "maximum_area_size": CALIBRATION_MAXIMUM_AREA_SIZE}
+    if roi:
+      self.parameters["roi_margin"] = ROI_MARGIN
+    self.roi = roi
+    self.images = {}
+    self.hits = self.misses = self.invalidated = 0
+    self.changed = False
+    self.lock = threading.Lock()
+
+    if os.path.exists(path):
+      with open(path) as file:
+        cache = json.load(file)
+      if cache.get("parameters") == self.parameters:
+        self.images = cache["images"]
+      else:
+        self.invalidated = len(cache.get("images", {}))
+        self.changed = True
+
+  def roi_stamp(self, file_path : str) -> int:
+    # Returns the modification time of the ROI file of the directory of an image in ROI mode, or None if there is none.
+    if not self.roi:
+      return None
+    roi_path = os.path.join(os.path.dirname(os.path.abspath(file_path)), ROI_FILE_NAME)
+    return os.stat(roi_path).st_mtime_ns if os.path.exists(roi_path) else None
+
+  def get(self, file_path : str) -> list:
+    # Returns the cached areas of an image, or None if the image is not cached or it or its ROI file has changed since.
+    status = os.stat(file_path)
+    roi_stamp = self.roi_stamp(file_path)
+    with self.lock:
+      entry = self.images.get(os.path.abspath(file_path))
+      if entry is not None and entry["size"] == status.st_size and entry["mtime_ns"] == status.st_mtime_ns and \
+          entry.get("roi_mtime_ns") == roi_stamp:
+        self.hits += 1
+        return entry["areas"]
+      self.misses += 1
+      return None
+
+  def put(self, file_path : str, areas : list) -> None:
+    # Stores the measured areas of an image.
+    status = os.stat(file_path)
+    roi_stamp = self.roi_stamp(file_path)
+    with self.lock:
+      self.images[os.path.abspath(file_path)] = {"size": status.st_size, "mtime_ns": status.st_mtime_ns, "roi_mtime_ns": roi_stamp,
+        "areas": list(areas)}
+      self.changed = True
+
+  def clear(self) -> None:
+    # Invalidates every cached image.
+    with self.lock:
+      self.invalidated += len(self.images)
+      self.images = {}
+      self.changed = True
+
+  def save(self) -> None:
+    # Writes the cache file if anything changed. The file is replaced at once so that an interrupted write does not corrupt it.
+    with self.lock:
+      if not self.changed:
+        return
+      with open(self.path + ".tmp", "w") as file:
+        json.dump({"parameters": self.parameters, "images": self.images}, file)
+      os.replace(self.path + ".tmp", self.path)
+      self.changed = False
+
+  def __str__(self) -> str:
+    lookups = self.hits + self.misses
+    return f"Area cache: {self.hits} hits, {self.misses} misses ({self.hits / lookups if lookups else 0:.1%} hit rate)" + \
+      (f", {self.invalidated} invalidated" if self.invalidated else "")
+
+def get_average_volume(dir, use_cache : bool = True, use_roi : bool = False):
   '''
-    Finds and prints the average volume of all images in a directory.
+    Finds and prints the average volume of all images in a directory. Files other than images are skipped.
 
     Parameters:
       Dir - Directory of the containing images.
+      Use_cache - Whether to look up and store the contour areas of the images in the AreaCache.
+      Use_roi - Whether to contour only the box of the fluid, see measure_areas().
   '''
 
 
   total_volume : float = 0
-  files = os.listdir(os.fsencode(dir))
+  files = [file for file in sorted(os.listdir(dir)) if file.lower().endswith(IMAGE_EXTENSIONS)]
+  if not files:
+    raise Exception(f"Could not find images in {dir}")
+  cache = AreaCache(roi=use_roi) if use_cache else None
   print("")
 
   # Loops through each image file and runs get_volume() to get the volume of a fluid inside a container from each image.
   for file in files:
-    file_path = f"{dir}/{file.decode('ascii')}"
-    image = cv2.imread(file_path)
-    volume = get_volume(image)
+    file_path = f"{dir}/{file}"
+    volume = measure_image(file_path, cache=cache, roi=use_roi)
     print(f"Reading image at {file_path}...\t{volume:.2f} mL")
     total_volume += volume
 
   print(f"\nThe total fluid in the container is about \x1b[38;5;154m{total_volume/len(files):.2f}\x1b[37m mL\n")
+  if cache is not None:
+    cache.save()
+    print(cache)
 
-selectedOption : str = display_laboratory_details()
-match selectedOption:
-  case "1": dir = "data/50mL"
-  case "2": dir = "data/100mL"
-  case "3": dir = "data/200mL"
-  case "4": dir = "data/350mL"
-  case "5": dir = "data/guess/A"
-  case "6": dir = "data/guess/B"
-  case "7": dir = "data/guess/C"
-  case _: raise Exception("No option selected. Please run the program again.")
-get_average_volume(dir)
+if __name__ == '__main__':
+  selectedOption : str = display_laboratory_details()
+  match selectedOption:
+    case "1": dir = "data/50mL"
+    case "2": dir = "data/100mL"
+    case "3": dir = "data/200mL"
+    case "4": dir = "data/350mL"
+    case "5": dir = "data/guess/A"
+    case "6": dir = "data/guess/B"
+    case "7": dir = "data/guess/C"
+    case _: raise Exception("No option selected. Please run the program again.")
+  get_average_volume(dir)
@@ -0,0 +1,245 @@
+'''
+  CMSC 174 Laboratory 4: Fluid Volume Estimation
+
+  File Name:    Ciudadano_lab04_batch.py
+  Author:       Gio Ciudadano
+  Modified:     18/10/2026 4:05pm
+
+  Description:  This program estimates the fluid volume of every image in one or more directories
+                at once, decoding and measuring several images in parallel.
+'''
+
+import os
+import re
+import sys
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from Ciudadano_lab04 import AREA_CACHE_FILE, DECODE_FLAGS, DECODE_SCALE, IMAGE_EXTENSIONS, ROI_FILE_NAME, AreaCache, get_volume_from_areas, measure_areas
+
+BATCH_QUEUE_SIZE = 2                      # Number of images in flight per worker. Bounds the decoded images held in memory at once.
+ACCURACY_TOLERANCE = 0.10                 # Largest accepted error of a directory average against its labelled volume, as a fraction.
+
+def list_images(directories : list) -> list:
+  '''
+    Lists the images of the given directories, in directory order.
+
+    Parameters:
+      Directories - The directories containing the images.
+
+    Returns:
+      Images - A list of (directory, file path) pairs.
+  '''
+  images = []
+  for directory in directories:
+    if not os.path.isdir(directory):
+      raise Exception(f"Could not find directory {directory}")
+    for file in sorted(os.listdir(directory)):
+      if file.lower().endswith(IMAGE_EXTENSIONS):
+        images.append((directory, os.path.join(directory, file)))
+  return images
+
+def timed_measure_areas(file_path : str, scale : int = DECODE_SCALE, roi : bool = False) -> tuple:
+  '''
+    Runs measure_areas() and returns the contour areas together with the number of seconds it took. Runs in a worker.
+
+    Parameters:
+      File_path - Path of the image.
+      Scale - The decode scale, see read_grayscale().
+      Roi - Whether to use ROI mode, see measure_areas().
+  '''
+  start = time.perf_counter()
+  areas = measure_areas(file_path, scale, roi)
+  return areas, time.perf_counter() - start
+
+def measure_images(images : list, workers : int = os.cpu_count(), processes : bool = False, queue_size : int = BATCH_QUEUE_SIZE, scale : int = DECODE_SCALE,
+    cache : AreaCache = None, roi : bool = False):
+  '''
+    Decodes and measures the given images on a pool of workers and yields each result as soon as it is measured, in completion order.
+    Only queue_size images per worker are submitted at a time. Threads are used by default, since OpenCV releases the GIL while decoding
+    and filtering. Images found in the cache are not decoded at all, and the areas of the other images are stored in it. In ROI mode, the box
+    of each directory is shared by the worker threads, while worker processes each detect it once.
+
+    Parameters:
+      Images - A list of (directory, file path) pairs, see list_images().
+      Workers - The number of worker threads or processes.
+      Processes - Whether to use worker processes instead of threads.
+      Queue_size - The number of images in flight per worker.
+      Scale - The decode scale, see read_grayscale().
+      Cache - An optional AreaCache for the same decode scale and ROI mode.
+      Roi - Whether to use ROI mode, see measure_areas().
+
+    Returns:
+      Results - (directory, file path, volume, seconds, cached, error) tuples. Cached is whether the areas were found in the cache, in which
+                case seconds is only the time of the lookup. The volume and seconds are None if measuring the image failed.
+  '''
+  if cache is not None and cache.parameters["decode_scale"] != scale:
+    raise Exception(f"The area cache is for decode scale {cache.parameters['decode_scale']}, not {scale}")
+  if cache is not None and roi != ("roi_margin" in cache.parameters):
+    raise Exception(f"The area cache is for {'' if roi else 'no '}ROI mode")
+
+  executor = ProcessPoolExecutor(max_workers=workers) if processes else ThreadPoolExecutor(max_workers=workers)
+  with executor:
+    pending = {}
+    next_image = 0
+    while next_image < len(images) or pending:
+      while next_image < len(images) and len(pending) < workers * queue_size:
+        directory, file_path = images[next_image]
+        next_image += 1
+        start = time.perf_counter()
+        areas = cache.get(file_path) if cache is not None else None
+        if areas is None:
+          pending[executor.submit(timed_measure_areas, file_path, scale, roi)] = (directory, file_path)
+          continue
+        try:
+          yield directory, file_path, get_volume_from_areas(areas), time.perf_counter() - start, True, None
+        except Exception as error:
+          yield directory, file_path, None, None, True, error
+      if not pending:
+        continue
+
+      done, _ = wait(pending, return_when=FIRST_COMPLETED)
+      for future in done:
+        directory, file_path = pending.pop(future)
+        try:
+          areas, seconds = future.result()
+          if cache is not None:
+            cache.put(file_path, areas)
+          yield directory, file_path, get_volume_from_areas(areas), seconds, False, None
+        except Exception as error:
+          yield directory, file_path, None, None, False, error
+
+def run_batch(directories : list, workers : int = os.cpu_count(), processes : bool = False, queue_size : int = BATCH_QUEUE_SIZE, scale : int = DECODE_SCALE,
+    cache : AreaCache = None, roi : bool = False) -> dict:
+  '''
+    Measures the images of the given directories with measure_images() and prints each volume as soon as it is measured.
+    Prints the average volume of each directory, the throughput and the 50th and 99th percentile latency per decoded image, and the hit
+    rate of the cache if one is given. Images found in the cache are counted separately. The cache is saved at the end.
+
+    Parameters:
+      Directories - The directories containing the images.
+      Workers, Processes, Queue_size, Scale, Cache, Roi - See measure_images().
+
+    Returns:
+      Volumes - A dictionary of the measured volumes of each directory.
+  '''
+  images = list_images(directories)
+  volumes = {directory: [] for directory in directories}
+  latencies = []
+  hits = 0
+  failures = 0
+
+  start = time.perf_counter()
+  for directory, file_path, volume, seconds, cached, error in measure_images(images, workers, processes, queue_size, scale, cache, roi):
+    if error is not None:
+      failures += 1
+      print(f"Reading image at {file_path}...\tfailed: {error}", file=sys.stderr)
+      continue
+    volumes[directory].append(volume)
+    if cached:
+      hits += 1
+      print(f"Reading image at {file_path}...\t{volume:.2f} mL\tcached")
+    else:
+      latencies.append(seconds)
+      print(f"Reading image at {file_path}...\t{volume:.2f} mL\t{seconds*1000:.0f} ms")
+  elapsed = time.perf_counter() - start
+
+  print("")
+  for directory in directories:
+    if volumes[directory]:
+      print(f"{directory}: about \x1b[38;5;154m{np.mean(volumes[directory]):.2f}\x1b[37m mL from {len(volumes[directory])} images")
+  print(f"\n{len(latencies) + hits} of {len(images)} images in {elapsed:.2f}s: {len(latencies)} decoded, {hits} from the cache")
+  if latencies:
+    print(f"Decoded {len(latencies)/elapsed:.2f} images/s, latency p50 {np.percentile(latencies, 50)*1000:.0f} ms, "
+      f"p99 {np.percentile(latencies, 99)*1000:.0f} ms")
+  if failures:
+    print(f"{failures} images failed", file=sys.stderr)
+  if cache is not None:
+    cache.save()
+    print(cache)
+  return volumes
+
+def labelled_directories(data_dir : str = "data") -> dict:
+  '''
+    Finds the directories of images with known volumes, named after their volume such as data/50mL.
+
+    Parameters:
+      Data_dir - The directory containing the labelled directories.
+
+    Returns:
+      Labels - A dictionary of the volume in mL of each labelled directory, sorted by volume.
+  '''
+  labels = {}
+  for name in os.listdir(data_dir):
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)mL", name)
+    if match and os.path.isdir(os.path.join(data_dir, name)):
+      labels[os.path.join(data_dir, name)] = float(match.group(1))
+  return dict(sorted(labels.items(), key=lambda label: label[1]))
+
+def accuracy_report(data_dir : str = "data", scales : list = list(DECODE_FLAGS), workers : int = os.cpu_count(), tolerance : float = ACCURACY_TOLERANCE) -> int:
+  '''
+    Measures the labelled directories at each decode scale and prints the error of the average volume of each directory against its label,
+    together with the time per image. Picks the fastest scale whose errors all stay within the tolerance.
+
+    Parameters:
+      Data_dir - The directory containing the labelled directories.
+      Scales - The decode scales to compare.
+      Workers - The number of worker threads.
+      Tolerance - The largest accepted error of a directory average, as a fraction of its label.
+
+    Returns:
+      Scale - The fastest scale within the tolerance, or None if no scale is.
+  '''
+  labels = labelled_directories(data_dir)
+  if not labels:
+    raise Exception(f"Could not find labelled directories such as 50mL in {data_dir}")
+  images = list_images(list(labels))
+
+  print(f"{'scale':>5} {'ms/image':>9} " + " ".join(f"{os.path.basename(directory):>8}" for directory in labels) + f" {'max error':>10}")
+  fastest = None
+  for scale in scales:
+    volumes = {directory: [] for directory in labels}
+    start = time.perf_counter()
+    for directory, file_path, volume, _, _, error in measure_images(images, workers, scale=scale):
+      if error is None:
+        volumes[directory].append(volume)
+    milliseconds = (time.perf_counter() - start) / len(images) * 1000
+
+    errors = [(np.mean(volumes[directory]) - label) / label if volumes[directory] else np.inf for directory, label in labels.items()]
+    max_error = max(abs(error) for error in errors)
+    print(f"{scale:>5} {milliseconds:>9.1f} " + " ".join(f"{error:>+8.1%}" for error in errors) + f" {max_error:>10.1%}")
+    if max_error <= tolerance and (fastest is None or milliseconds < fastest[1]):
+      fastest = (scale, milliseconds)
+
+  if fastest is None:
+    print(f"\nNo scale stays within {tolerance:.0%} of the labelled volumes")
+    return None
+  print(f"\nFastest scale within {tolerance:.0%} of the labelled volumes: {fastest[0]} ({fastest[1]:.1f} ms/image)")
+  return fastest[0]
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Estimates the fluid volume of every image in the given directories.")
+  parser.add_argument('directories', nargs='*', help="directories of images, e.g. data/50mL data/guess/A")
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of workers (default: number of CPUs)")
+  parser.add_argument('--processes', action='store_true', help="use worker processes instead of threads")
+  parser.add_argument('--queue-size', type=int, default=BATCH_QUEUE_SIZE, help=f"images in flight per worker (default: {BATCH_QUEUE_SIZE})")
+  parser.add_argument('--scale', type=int, default=DECODE_SCALE, choices=list(DECODE_FLAGS), help="decode images this many times smaller (default: %(default)s)")
+  parser.add_argument('--accuracy-report', metavar='DATA_DIR', nargs='?', const='data', help="compare the decode scales on the labelled directories of DATA_DIR (default: data)")
+  parser.add_argument('--roi', action='store_true', help=f"contour only the box of the fluid, detected once per directory or read from its {ROI_FILE_NAME}")
+  parser.add_argument('--no-cache', action='store_true', help="do not look up or store contour areas in the area cache")
+  parser.add_argument('--clear-cache', action='store_true', help="invalidate every image in the area cache before measuring")
+  parser.add_argument('--cache-file', default=AREA_CACHE_FILE, help="area cache file (default: %(default)s)")
+  parser.add_argument('--tolerance', type=float, default=ACCURACY_TOLERANCE, help="largest accepted error for the accuracy report, as a fraction (default: %(default)s)")
+  args = parser.parse_args()
+
+  if args.accuracy_report:
+    accuracy_report(args.accuracy_report, list(DECODE_FLAGS), args.workers, args.tolerance)
+  elif args.directories:
+    cache = None if args.no_cache else AreaCache(args.cache_file, args.scale, args.roi)
+    if cache is not None and args.clear_cache:
+      cache.clear()
+    run_batch(args.directories, args.workers, args.processes, args.queue_size, args.scale, cache, args.roi)
+  else:
+    parser.error("Please give at least one directory, or --accuracy-report")
@@ -0,0 +1,150 @@
+'''
+  CMSC 174 Laboratory 4: Fluid Volume Estimation
+
+  File Name:    Ciudadano_lab04_calibration.py
+  Author:       Gio Ciudadano
+  Modified:     18/10/2026 4:40pm
+
+  Description:  This program fits the calibration constants of Ciudadano_lab04.py to the directories
+                of images with known volumes, and saves them to the calibration file.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import functools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import Ciudadano_lab04
+from Ciudadano_lab04 import CALIBRATION_FILE, DECODE_FLAGS, get_contour_areas, read_grayscale
+from Ciudadano_lab04_batch import labelled_directories, list_images
+
+CALIBRATION_SCALE = 4                     # Decode scale used while calibrating. Each parameter set is tried on every labelled image.
+CALIBRATION_THRESHOLDS = range(50, 131, 5)  # Threshold cutoffs and dilate/erode iterations, in decoded pixels, tried while calibrating.
+CALIBRATION_ITERATIONS = range(1, 6)
+
+@functools.lru_cache(maxsize=None)
+def load_labelled_images(data_dir : str = "data", scale : int = CALIBRATION_SCALE, workers : int = os.cpu_count()) -> tuple:
+  '''
+    Decodes every image of the labelled directories once as grayscale and keeps them in memory for the following calls.
+
+    Parameters:
+      Data_dir - The directory containing the labelled directories, such as data/50mL.
+      Scale - The decode scale, see read_grayscale().
+      Workers - The number of decoder threads.
+
+    Returns:
+      Images, Volumes - The grayscale images and the labelled volume of each image.
+  '''
+  labels = labelled_directories(data_dir)
+  images = list_images(list(labels))
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    grays = list(executor.map(lambda image: read_grayscale(image[1], scale), images))
+  return grays, np.array([labels[directory] for directory, _ in images])
+
+def fit_pixel_value(areas : np.array, volumes : np.array) -> tuple:
+  '''
+    Fits the pixel value for which areas / pixel value best matches the volumes, by least squares on the volumes.
+
+    Parameters:
+      Areas - The area of the fluid contour of each image, in full-size pixels.
+      Volumes - The labelled volume of each image.
+
+    Returns:
+      Pixel_value, Error - The fitted pixel value and the root mean squared error of the fitted volumes in mL.
+  '''
+  volume_per_pixel = np.dot(areas, volumes) / np.dot(areas, areas)
+  error = np.sqrt(np.mean((areas * volume_per_pixel - volumes)**2))
+  return 1 / volume_per_pixel, error
+
+def evaluate_parameters(images : list, volumes : np.array, scale : int, threshold : int, iterations : int) -> dict:
+  '''
+    Measures the fluid contour of every image with the given threshold and dilate/erode iterations, and fits the pixel value to them.
+    Runs in a worker thread.
+
+    Parameters:
+      Images, Volumes - The grayscale images and labelled volumes, see load_labelled_images().
+      Scale - The decode scale of the images.
+      Threshold - The threshold cutoff.
+      Iterations - The dilate/erode iterations, in decoded pixels.
+
+    Returns:
+      Calibration - The parameters with the fitted pixel value and error, or None if the fluid was not found in some image.
+  '''
+  areas = []
+  for image in images:
+    contour_areas = get_contour_areas(image, scale, threshold, iterations * scale)
+    if not contour_areas:
+      return None
+    areas.append(max(contour_areas))
+  pixel_value, error = fit_pixel_value(np.array(areas), volumes)
+  return {"minimum_threshold": threshold, "dilate_erode_iters": iterations * scale, "pixel_value": pixel_value,
+    "decode_scale": scale, "rmse": error}
+
+def calibrate(data_dir : str = "data", scale : int = CALIBRATION_SCALE, thresholds : list = CALIBRATION_THRESHOLDS,
+    iterations : list = CALIBRATION_ITERATIONS, workers : int = os.cpu_count()) -> list:
+  '''
+    Tries every combination of threshold and dilate/erode iterations on the labelled images in parallel, fitting the pixel value of each.
+
+    Parameters:
+      Data_dir - The directory containing the labelled directories.
+      Scale - The decode scale.
+      Thresholds, Iterations - The threshold cutoffs and dilate/erode iterations in decoded pixels to try.
+      Workers - The number of worker threads. OpenCV releases the GIL while filtering, so the combinations run in parallel.
+
+    Returns:
+      Calibrations - The calibrations of every combination where the fluid was found in every image, best first.
+  '''
+  images, volumes = load_labelled_images(data_dir, scale, workers)
+  combinations = [(threshold, iteration) for threshold in thresholds for iteration in iterations]
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    results = executor.map(lambda combination: evaluate_parameters(images, volumes, scale, *combination), combinations)
+    calibrations = [result for result in results if result is not None]
+  return sorted(calibrations, key=lambda calibration: calibration["rmse"])
+
+def save_calibration(calibration : dict, path : str = CALIBRATION_FILE) -> None:
+  '''
+    Saves a calibration for get_volume() to load, see Ciudadano_lab04.load_calibration().
+
+    Parameters:
+      Calibration - The calibration to save.
+      Path - Path of the calibration file.
+  '''
+  with open(path, "w") as file:
+    json.dump(calibration, file, indent=2)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Fits the calibration constants to the directories of images with known volumes.")
+  parser.add_argument('--data-dir', default="data", help="directory containing the labelled directories such as 50mL (default: data)")
+  parser.add_argument('--scale', type=int, default=CALIBRATION_SCALE, choices=list(DECODE_FLAGS), help="decode scale (default: %(default)s)")
+  parser.add_argument('--thresholds', type=int, nargs=3, metavar=('START', 'STOP', 'STEP'),
+    default=(CALIBRATION_THRESHOLDS.start, CALIBRATION_THRESHOLDS.stop, CALIBRATION_THRESHOLDS.step), help="threshold cutoffs to try")
+  parser.add_argument('--iterations', type=int, nargs=2, metavar=('MIN', 'MAX'),
+    default=(CALIBRATION_ITERATIONS.start, CALIBRATION_ITERATIONS.stop - 1), help="dilate/erode iterations in decoded pixels to try")
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of worker threads (default: number of CPUs)")
+  parser.add_argument('--output', default=CALIBRATION_FILE, help="calibration file to write (default: %(default)s)")
+  parser.add_argument('--dry-run', action='store_true', help="only print the best calibrations")
+  args = parser.parse_args()
+
+  start = time.perf_counter()
+  images, _ = load_labelled_images(args.data_dir, args.scale, args.workers)
+  print(f"Decoded {len(images)} labelled images in {time.perf_counter() - start:.2f}s")
+
+  start = time.perf_counter()
+  calibrations = calibrate(args.data_dir, args.scale, range(*args.thresholds), range(args.iterations[0], args.iterations[1] + 1), args.workers)
+  print(f"Tried {len(range(*args.thresholds)) * (args.iterations[1] - args.iterations[0] + 1)} parameter sets in {time.perf_counter() - start:.2f}s\n")
+  if not calibrations:
+    sys.exit("The fluid was not found in every image with any of the parameter sets")
+
+  print(f"{'threshold':>9} {'iterations':>10} {'pixel value':>11} {'rmse':>8}")
+  for calibration in calibrations[:5]:
+    print(f"{calibration['minimum_threshold']:>9} {calibration['dilate_erode_iters']:>10} {calibration['pixel_value']:>11.1f} {calibration['rmse']:>6.2f}mL")
+  print(f"\nHand-tuned constants: threshold {Ciudadano_lab04.CALIBRATION_MINIMUM_THRESHOLD}, iterations {Ciudadano_lab04.CALIBRATION_DILATE_ERODE_ITERS}, "
+    f"pixel value {Ciudadano_lab04.CALIBRATION_PIXEL_VALUE}")
+
+  if not args.dry_run:
+    save_calibration(calibrations[0], args.output)
+    print(f"Saved the best calibration to {args.output}")